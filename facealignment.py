@@ -1,17 +1,35 @@
+import os
+import sys
+import time
+import json
+import shutil
+import hashlib
+import argparse
+import zipfile
+import tracemalloc
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, namedtuple
+from itertools import islice
+from functools import lru_cache, partial
+from types import SimpleNamespace
 import numpy as np
-import matplotlib.pyplot as plt
 import cv2
-from sklearn import linear_model
-from sklearn.metrics import mean_squared_error
-from sklearn.model_selection import train_test_split
+
+# matplotlib and sklearn are only imported where they are used, so that loading a saved
+# cascade and predicting with it stays fast
 
 # Useful functions
 def visualise_pts(img, pts):
+    import matplotlib.pyplot as plt
     plt.imshow(img, cmap='gray')
     plt.plot(pts[:, 0], pts[:, 1], '+r')
     plt.show()
 
 def visualise_3pts(img, pts, pts2, pts3):
+    import matplotlib.pyplot as plt
     plt.imshow(img, cmap='gray')
     plt.plot(pts[:, 0], pts[:, 1], '+r')
     plt.plot(pts2[:, 0], pts2[:, 1], '+g')
@@ -40,19 +58,6 @@ def save_as_csv(points, location = '.'):
     assert np.prod(points.shape[1:])==5*2, 'wrong number of points provided. There should be 5 points with 2 values (x,y) per point'
     np.savetxt(location + '/results_task2.csv', np.reshape(points, (points.shape[0], -1)), delimiter=',')
 
-# Load the train data using np.load
-train_data = np.load('face_alignment_training_images.npz', allow_pickle=True)
-
-# Extract the training images and points
-train_images = train_data['images']
-train_points = train_data['points']
-
-# Load the test data
-test_data = np.load('face_alignment_test_images.npz', allow_pickle=True)
-
-# Extract the testing images
-test_images = test_data['images']
-
 # Preprocess an array of images
 def preprocess(images, scale):
     preprocess_images = []
@@ -65,6 +70,42 @@ def preprocess(images, scale):
         preprocess_images.append(greyscaled_img)
     return np.array(preprocess_images)
 
+# Fixed point RGB to grey weights cv2.cvtColor uses for 8 bit images
+grey_weights = np.array([9798, 19235, 3735], dtype=np.uint32)
+grey_shift = 15
+
+def preprocess_batch(images, scale, out=None, vectorized=False, chunk_size=32):
+    """
+    Same result as preprocess, but every image is written straight into one preallocated array
+    instead of a list which is then copied
+    :param images: numpy array of shape (no_images, height, width, 3) of RGB images
+    :param scale: The resize scale
+    :param out: Optional uint8 array of shape (no_images, new_height, new_width) to write to
+    :param vectorized: At a scale of 0.25 bilinear resizing takes the rounded mean of the middle 2x2
+        pixels of every 4x4 block, so resize and greyscale whole chunks of the stack with NumPy
+        instead of calling OpenCV per image. The result is identical, but OpenCV is faster on one core
+    :param chunk_size: Number of images converted at once by the vectorized path
+    :return: The preprocessed images
+    """
+    num_images, height, width = images.shape[:3]
+    # preprocess passes (height, width) to cv2.resize, which takes (width, height)
+    new_size = (int(height * scale), int(width * scale))
+    if out is None:
+        out = np.empty((num_images, new_size[1], new_size[0]), dtype=np.uint8)
+
+    if vectorized and scale == 0.25 and height == width and height % 4 == 0:
+        for start in range(0, num_images, chunk_size):
+            chunk = images[start:start + chunk_size]
+            resized = (chunk[:, 1::4, 1::4].astype(np.uint16) + chunk[:, 1::4, 2::4]
+                       + chunk[:, 2::4, 1::4] + chunk[:, 2::4, 2::4] + 2) >> 2
+            resized = resized.astype(np.uint32)
+            out[start:start + len(chunk)] = (resized[..., 0] * grey_weights[0] + resized[..., 1] * grey_weights[1]
+                                             + resized[..., 2] * grey_weights[2] + (1 << (grey_shift - 1))) >> grey_shift
+    else:
+        for i, img in enumerate(images):
+            out[i] = cv2.cvtColor(cv2.resize(img, new_size), cv2.COLOR_RGB2GRAY)
+    return out
+
 # Resize an array of points by the scale
 def resize_points(pointsArr, scale):
     resized_pointsArr = []
@@ -73,76 +114,987 @@ def resize_points(pointsArr, scale):
     return np.array(resized_pointsArr)
 
 resize_scale = 0.25 # Used for all images and points
-
-# Preprocess the train and test images
-train_images_preprocessed = preprocess(train_images, resize_scale)
-test_images_preprocessed = preprocess(test_images, resize_scale)
-
-# Then resize the train points to match the new image size
-train_points_resized = resize_points(train_points, resize_scale)
-
-# Find the average of all the training points for initial SIFT descriptor keypoints
-average_points = np.mean(train_points_resized, axis=0)
-print("average points:\n", average_points)
+# Use a keypoint size going of original 256x256 image size, then scale it
+keypoint_size = 10 * resize_scale
+# Floating point type of the features, coefficients and points, SIFT descriptors are already float32
+compute_dtype = np.float32
 
 # create sift object
 sift = cv2.SIFT_create()
+thread_data = threading.local()
+
+def thread_sift():
+    """
+    Get the sift object for the calling thread, the module level one isn't safe to share between
+    threads so every worker thread creates its own
+    """
+    if threading.current_thread() is threading.main_thread():
+        return sift
+    if not hasattr(thread_data, 'sift'):
+        thread_data.sift = cv2.SIFT_create()
+    return thread_data.sift
 
-def compute_descriptors(image, points):
-    # Use a keypoint size going of original 256x256 image size, then scale it
-    keypoint_size = 10 * resize_scale
+def compute_descriptors(image, points, patch=False, keypoint_size=keypoint_size):
+    if patch:
+        return compute_patch_descriptors(image, points, keypoint_size)
     keypoints = [cv2.KeyPoint(float(x), float(y), keypoint_size) for (x, y) in points]
     # Use sift.compute at the keypoint
-    keypoints, descriptors = sift.compute(image, keypoints)  
+    keypoints, descriptors = thread_sift().compute(image, keypoints)  
+    return descriptors
+
+def descriptor_margin(keypoint_size):
+    """
+    Distance from a keypoint beyond which sift.compute never reads the image
+    :param keypoint_size: The keypoint size as passed to cv2.KeyPoint
+    :return: The margin in pixels, the descriptor radius plus the support of the blur and gradients
+    """
+    hist_width = 3 * keypoint_size * 0.5
+    radius = int(round(hist_width * np.sqrt(2) * (4 + 1) * 0.5))
+    return radius + int(round(4 * gradient_sigma)) + 2
+
+def compute_patch_descriptors(image, points, keypoint_size=keypoint_size):
+    """
+    Compute the same descriptors as compute_descriptors, but only hand sift.compute the part of the
+    image around the points. Either the bounding box of all the windows is cropped, or when the
+    windows are far apart and none is clipped by the image border, each window is cropped and the
+    5 are tiled side by side into a mosaic
+    :param image: A preprocessed greyscale image
+    :param points: numpy array of shape (no_points, 2)
+    :return: An array of shape (no_points, 128) containing the descriptor of each point
+    """
+    height, width = image.shape[:2]
+    centres = np.round(points).astype(int)
+    # Points off the image would need the whole image border handling, so describe the full image
+    if np.any(centres < 0) or np.any(centres >= [width, height]):
+        return compute_descriptors(image, points, keypoint_size=keypoint_size)
+
+    margin = descriptor_margin(keypoint_size)
+    side = 2 * margin + 1
+    lower = np.maximum(centres - margin, 0)
+    upper = np.minimum(centres + margin + 1, [width, height])
+    (x0, y0), (x1, y1) = lower.min(axis=0), upper.max(axis=0)
+
+    # sift.compute skips samples off the image, which padding a clipped window can't reproduce, so the
+    # mosaic is only used when every window lies inside the image
+    clipped = np.any(lower != centres - margin) or np.any(upper != centres + margin + 1)
+    if clipped or (x1 - x0) * (y1 - y0) <= len(points) * side * side:
+        crop = image[y0:y1, x0:x1]
+        offsets = np.array([[x0, y0]] * len(points))
+    else:
+        crop = np.empty((side, side * len(points)), dtype=image.dtype)
+        for k, (cx, cy) in enumerate(centres):
+            crop[:, k * side:(k + 1) * side] = image[cy - margin:cy + margin + 1, cx - margin:cx + margin + 1]
+        offsets = centres - margin - np.arange(len(points))[:, None] * [side, 0]
+
+    keypoints = [cv2.KeyPoint(float(x - ox), float(y - oy), keypoint_size) for (x, y), (ox, oy) in zip(points, offsets)]
+    keypoints, descriptors = thread_sift().compute(crop, keypoints)
     return descriptors
 
-def cascaded_regression(num_regressors, damping_factors, train_images, train_points):
+def compute_stage_features(images, shapes, patch=False, keypoint_size=keypoint_size):
+    """
+    Compute the SIFT feature matrix for one stage of the cascade
+    :param images: The preprocessed images
+    :param shapes: numpy array of shape (no_images, no_points, 2) with the current predicted points
+    :param patch: Describe only the patches around the points, see compute_patch_descriptors
+    :param keypoint_size: The keypoint size as passed to cv2.KeyPoint
+    :return: An array of shape (no_images, no_points * 128) containing one flattened descriptor row per image
+    """
+    return np.array([compute_descriptors(img, pts, patch, keypoint_size).flatten() for img, pts in zip(images, shapes)], dtype=np.float32)
+
+def atlas_descriptors(images, shapes, images_per_atlas=64, keypoint_size=keypoint_size):
+    """
+    Compute the SIFT feature matrix for one stage of the cascade with one sift.compute call per atlas
+    of images rather than per image. Each image is placed in a grid with a reflected guard border wide
+    enough that no descriptor reads a neighbouring image
+    :param images: numpy array of shape (no_images, height, width) of preprocessed greyscale images
+    :param shapes: numpy array of shape (no_images, no_points, 2) with the current predicted points
+    :param images_per_atlas: Maximum number of images tiled into each atlas
+    :param keypoint_size: The keypoint size as passed to cv2.KeyPoint, the guard border grows with it
+    :return: An array of shape (no_images, no_points * 128) containing one flattened descriptor row per image
+    """
+    height, width = images.shape[1:3]
+    margin = descriptor_margin(keypoint_size)
+    tile_height, tile_width = height + 2 * margin, width + 2 * margin
+    columns = int(np.ceil(np.sqrt(images_per_atlas)))
+
+    features = []
+    for start in range(0, len(images), images_per_atlas):
+        batch, batch_shapes = images[start:start + images_per_atlas], shapes[start:start + images_per_atlas]
+        rows = int(np.ceil(len(batch) / columns))
+        atlas = np.zeros((rows * tile_height, columns * tile_width), dtype=images.dtype)
+        keypoints = []
+        for k, (img, pts) in enumerate(zip(batch, batch_shapes)):
+            top, left = (k // columns) * tile_height, (k % columns) * tile_width
+            atlas[top:top + tile_height, left:left + tile_width] = cv2.copyMakeBorder(
+                img, margin, margin, margin, margin, cv2.BORDER_REFLECT_101)
+            # Offset the keypoints of each image to its place in the atlas
+            keypoints += [cv2.KeyPoint(float(x + left + margin), float(y + top + margin), keypoint_size) for (x, y) in pts]
+
+        keypoints, descriptors = thread_sift().compute(atlas, keypoints)
+        assert len(keypoints) == shapes.shape[1] * len(batch), 'sift.compute dropped keypoints from the atlas'
+        features.append(descriptors.reshape(len(batch), -1))
+    return np.concatenate(features)
+
+def best_time(run, repeats=3):
+    """
+    Time a benchmark run several times, keeping the fastest since slower runs are mostly noise
+    :param run: Function taking no arguments to time
+    :param repeats: Number of timed runs
+    :return: The shortest time in seconds, and the output of the last run
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        output = run()
+        best = min(best, time.perf_counter() - start_time)
+    return best, output
+
+def benchmark_atlas(images, shapes, sizes=(1, 4, 16, 64, 256), repeats=3):
+    """
+    Sweep the number of images per atlas to find the best throughput
+    :param images: The preprocessed images to describe
+    :param shapes: numpy array of shape (no_images, no_points, 2) of points to describe
+    :param sizes: The values of images_per_atlas to try
+    :param repeats: Number of timed runs, the best one is reported
+    :return: A dict mapping each atlas size (None for per-image calls) to its images/second
+    """
+    reference = compute_stage_features(images, shapes)
+    results = {}
+    for size in (None,) + tuple(sizes):
+        if size is None:
+            best, features = best_time(lambda: compute_stage_features(images, shapes), repeats)
+        else:
+            best, features = best_time(lambda: atlas_descriptors(images, shapes, size), repeats)
+        results[size] = len(images) / best
+        print("images per atlas %s: %.1f images/s, max difference %g" % (
+            size or 'per image', results[size], np.max(np.abs(features - reference))))
+    return results
+
+def threaded_features(images, shapes, extract=compute_stage_features, num_workers=None, chunk_size=32):
+    """
+    Compute the feature matrix for one stage over a thread pool, OpenCV releases the GIL inside
+    sift.compute so the chunks are described in parallel. Rows come back in input order
+    :param extract: The per chunk feature function, e.g. compute_stage_features or batch_descriptors
+    :param num_workers: Number of threads, defaults to the number of cores
+    :param chunk_size: Number of images handed to a thread at a time
+    :return: An array of shape (no_images, no_points * 128) containing one flattened descriptor row per image
+    """
+    starts = range(0, len(images), chunk_size)
+    with ThreadPoolExecutor(num_workers or os.cpu_count()) as executor:
+        chunks = executor.map(lambda start: extract(images[start:start + chunk_size], shapes[start:start + chunk_size]), starts)
+        return np.concatenate(list(chunks))
+
+def benchmark_threads(images, shapes, max_workers=None, repeats=3):
+    """
+    Measure how threaded_features scales from 1 thread up to all cores
+    :param images: The preprocessed images to describe
+    :param shapes: numpy array of shape (no_images, no_points, 2) of points to describe
+    :param max_workers: Largest number of threads to try, defaults to the number of cores
+    :param repeats: Number of timed runs, the best one is reported
+    :return: A dict mapping each number of threads to its images/second
+    """
+    reference = compute_stage_features(images, shapes)
+    results = {}
+    for num_workers in range(1, (max_workers or os.cpu_count()) + 1):
+        best, features = best_time(lambda: threaded_features(images, shapes, num_workers=num_workers), repeats)
+        assert np.array_equal(features, reference), 'threaded features differ from the serial ones'
+        results[num_workers] = len(images) / best
+        print("%d threads: %.1f images/s (%.2fx)" % (num_workers, results[num_workers], results[num_workers] / results[1]))
+    return results
+
+# Image stack and feature function of a worker process, set by attach_shared_images
+worker_state = {}
+
+def attach_shared_images(name, shape, dtype, extract):
+    """
+    Pool initializer mapping the shared image stack into a worker process without copying it
+    """
+    memory = shared_memory.SharedMemory(name=name)
+    worker_state['memory'] = memory
+    worker_state['images'] = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+    worker_state['extract'] = extract
+
+def shard_features(indices, shapes):
+    """
+    Compute the features of the images at indices of the shared stack inside a worker process
+    """
+    return worker_state['extract'](subset(worker_state['images'], indices, gather=True), shapes)
+
+def stack_indices(stack, images):
+    """
+    Find which rows of a stack some images are, when they are the stack itself, a view of its rows
+    (e.g. a slice) or a StackSubset of any of those
+    :return: The index of each image in the stack, or None if the images aren't rows of the stack
+    """
+    if images is stack:
+        return np.arange(len(images))
+    if isinstance(images, StackSubset):
+        indices = stack_indices(stack, images.stack)
+        return None if indices is None else indices[images.indices]
+    if not (isinstance(images, np.ndarray) and isinstance(stack, np.ndarray)) or not np.may_share_memory(images, stack):
+        return None
+    if images.dtype != stack.dtype or images.shape[1:] != stack.shape[1:] or images.strides[1:] != stack.strides[1:]:
+        return None
+    # Work out the first row and the step between rows from where the view starts in the stack's memory
+    offset = images.__array_interface__['data'][0] - stack.__array_interface__['data'][0]
+    row_bytes = stack.strides[0]
+    if offset % row_bytes or images.strides[0] % row_bytes:
+        return None
+    indices = offset // row_bytes + images.strides[0] // row_bytes * np.arange(len(images))
+    if len(indices) and (indices.min() < 0 or indices.max() >= len(stack)):
+        return None
+    return indices
+
+class ProcessPoolFeatures:
+    """
+    Stage feature extraction sharded over worker processes. The image stack is copied once into
+    shared memory which every worker maps, so each stage only scatters the current shapes and
+    gathers the (no_images, no_features) shards, the regression itself is still solved by the parent.
+    Use as a context manager, or call close() to stop the workers and free the shared memory
+    """
+    def __init__(self, images, num_workers=None, extract=compute_stage_features, shards_per_worker=4):
+        self.images = images
+        self.extract = extract
+        self.num_workers = num_workers or os.cpu_count()
+        self.shards_per_worker = shards_per_worker
+        self.memory = shared_memory.SharedMemory(create=True, size=max(images.nbytes, 1))
+        shared = np.ndarray(images.shape, dtype=images.dtype, buffer=self.memory.buf)
+        shared[:] = images
+        self.pool = multiprocessing.Pool(self.num_workers, initializer=attach_shared_images,
+                                         initargs=(self.memory.name, images.shape, images.dtype.str, extract))
+
+    def __call__(self, images, shapes):
+        """
+        Compute the feature matrix for one stage, can be passed as extract to cascaded_regression
+        and regression_predict. The images must be rows of the shared stack: the stack itself, a slice
+        of it or a StackSubset of it, such as the chunks and splits those functions pass in
+        """
+        indices = stack_indices(self.images, images)
+        if indices is None:
+            raise ValueError("ProcessPoolFeatures can only describe rows of the stack it was created with")
+        bounds = np.linspace(0, len(indices), self.num_workers * self.shards_per_worker + 1).astype(int)
+        shards = [(indices[start:stop], shapes[start:stop]) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+        return np.concatenate(self.pool.starmap(shard_features, shards))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def benchmark_processes(images, shapes, max_workers=None, repeats=3):
+    """
+    Measure how ProcessPoolFeatures scales from 1 worker process up to all cores
+    :param images: The preprocessed images to describe
+    :param shapes: numpy array of shape (no_images, no_points, 2) of points to describe
+    :param max_workers: Largest number of processes to try, defaults to the number of cores
+    :param repeats: Number of timed runs, the best one is reported
+    :return: A dict mapping each number of processes to its images/second
+    """
+    reference = compute_stage_features(images, shapes)
+    results = {}
+    for num_workers in range(1, (max_workers or os.cpu_count()) + 1):
+        with ProcessPoolFeatures(images, num_workers) as extract:
+            best, features = best_time(lambda: extract(images, shapes), repeats)
+        assert np.array_equal(features, reference), 'sharded features differ from the serial ones'
+        results[num_workers] = len(images) / best
+        print("%d processes: %.1f images/s (%.2fx)" % (num_workers, results[num_workers], results[num_workers] / results[1]))
+    return results
+
+# Gaussian blur applied by SIFT to the base of its scale space (sigma 1.6 over an assumed 0.5)
+gradient_sigma = np.sqrt(1.6 ** 2 - 0.5 ** 2)
+
+def batch_gradients(images):
+    """
+    Compute the smoothed gradient maps SIFT builds its descriptors from, for a whole stack of images
+    :param images: numpy array of shape (no_images, height, width) of preprocessed greyscale images
+    :return: A float32 array of shape (no_images, 2, height, width) containing the x and y gradients
+    """
+    # Separable Gaussian blur with the same kernel size and border handling as cv2.GaussianBlur
+    radius = int(round(4 * gradient_sigma))
+    kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / gradient_sigma) ** 2)
+    kernel = (kernel / kernel.sum()).astype(np.float32)
+    padded = np.pad(np.asarray(images, dtype=np.float32), ((0, 0), (radius, radius), (radius, radius)), mode='reflect')
+    height, width = padded.shape[1] - 2 * radius, padded.shape[2] - 2 * radius
+    rows = sum(k * padded[:, :, i:i + width] for i, k in enumerate(kernel))
+    smoothed = sum(k * rows[:, i:i + height] for i, k in enumerate(kernel))
+
+    # Central differences, repeating the edge pixels
+    padded = np.pad(smoothed, ((0, 0), (1, 1), (1, 1)), mode='edge')
+    gx = padded[:, 1:-1, 2:] - padded[:, 1:-1, :-2]
+    gy = padded[:, 2:, 1:-1] - padded[:, :-2, 1:-1]
+    return np.stack([gx, gy], axis=1)
+
+def compute_gradients(image):
+    """
+    Compute the smoothed gradient maps of a single image
+    :param image: A preprocessed greyscale image
+    :return: A float32 array of shape (2, height, width) containing the x and y gradients
+    """
+    return batch_gradients(image[None])[0]
+
+@lru_cache(maxsize=None)
+def descriptor_grid(keypoint_size, d=4, n=8):
+    """
+    Build the sample offsets and spatial histogram weights of a SIFT descriptor, these only
+    depend on the keypoint size so are shared by every landmark
+    :param keypoint_size: The keypoint size as passed to cv2.KeyPoint
+    :param d: Number of spatial bins along each side of the descriptor
+    :param n: Number of orientation bins
+    :return: Offsets of shape (no_samples, 2) and weights of shape (d * d, no_samples)
+    """
+    # Same support as OpenCV's calcSIFTDescriptor for an upright keypoint
+    hist_width = 3 * keypoint_size * 0.5
+    radius = int(round(hist_width * np.sqrt(2) * (d + 1) * 0.5))
+    v, u = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    u, v = u.ravel() / hist_width, v.ravel() / hist_width
+    rbin, cbin = v + d / 2 - 0.5, u + d / 2 - 0.5
+    gaussian = np.exp(-(u ** 2 + v ** 2) / (0.5 * d * d))
+
+    # Bilinear weight of every sample into its (up to) 4 neighbouring spatial bins
+    weights = np.zeros((d * d, len(u)))
+    r0, c0 = np.floor(rbin).astype(int), np.floor(cbin).astype(int)
+    for dr in (0, 1):
+        for dc in (0, 1):
+            r, c = r0 + dr, c0 + dc
+            w = (1 - np.abs(rbin - r)) * (1 - np.abs(cbin - c)) * gaussian
+            valid = (r >= 0) & (r < d) & (c >= 0) & (c < d)
+            np.add.at(weights, (r[valid] * d + c[valid], np.flatnonzero(valid)), w[valid])
+
+    keep = weights.any(axis=0)
+    offsets = np.stack([u, v], axis=1)[keep] * hist_width
+    return offsets, weights[:, keep]
+
+def bilinear_sample(maps, x, y):
+    """
+    Sample a stack of maps at subpixel positions, clamping to the image border
+    :param maps: numpy array of shape (no_images, no_maps, height, width)
+    :param x: x positions of shape (no_images, ...)
+    :param y: y positions, same shape as x
+    :return: An array of shape (no_maps,) + x.shape
+    """
+    height, width = maps.shape[-2:]
+    x = np.clip(x, 0, width - 1)
+    y = np.clip(y, 0, height - 1)
+    x0 = np.minimum(np.floor(x).astype(int), width - 2)
+    y0 = np.minimum(np.floor(y).astype(int), height - 2)
+    fx, fy = (x - x0)[..., None], (y - y0)[..., None]
+
+    # Gather from one flat (pixels, maps) table so each corner is a single take
+    table = np.ascontiguousarray(maps.transpose(0, 2, 3, 1)).reshape(-1, maps.shape[1])
+    b = np.arange(len(maps)).reshape((-1,) + (1,) * (x.ndim - 1))
+    index = (b * height + y0) * width + x0
+    top = table[index] * (1 - fx) + table[index + 1] * fx
+    bottom = table[index + width] * (1 - fx) + table[index + width + 1] * fx
+    return np.moveaxis(top * (1 - fy) + bottom * fy, -1, 0)
+
+def gradient_histograms(gx, gy, weights, n=8):
+    """
+    Turn sampled gradients into normalised SIFT descriptors
+    :param gx: x gradients of shape (..., no_samples)
+    :param gy: y gradients of shape (..., no_samples), y pointing down the image
+    :param weights: Spatial weights from descriptor_grid
+    :param n: Number of orientation bins
+    :return: An array of shape (..., d * d * n) scaled like OpenCV's float SIFT descriptors
+    """
+    # OpenCV measures the orientation with y pointing up the image
+    magnitude = np.hypot(gx, gy)
+    obin = (np.arctan2(-gy, gx) % (2 * np.pi)) * (n / (2 * np.pi))
+    o0 = np.floor(obin).astype(int) % n
+    fo = obin - np.floor(obin)
+
+    # Linear interpolation between the two nearest orientation bins
+    orientation = np.zeros(magnitude.shape + (n,), dtype=magnitude.dtype)
+    np.put_along_axis(orientation, o0[..., None], (magnitude * (1 - fo))[..., None], axis=-1)
+    np.put_along_axis(orientation, ((o0 + 1) % n)[..., None], (magnitude * fo)[..., None], axis=-1)
+    hist = np.matmul(weights, orientation).reshape(magnitude.shape[:-1] + (-1,))
+
+    # Clip large values and normalise as SIFT does
+    norm = np.linalg.norm(hist, axis=-1, keepdims=True)
+    hist = np.minimum(hist, 0.2 * norm)
+    norm = np.linalg.norm(hist, axis=-1, keepdims=True)
+    hist = np.clip(np.round(hist * (512 / np.maximum(norm, np.finfo(np.float32).eps))), 0, 255)
+    return hist.astype(np.float32)
+
+def sample_descriptors(gradients, shapes, keypoint_size=keypoint_size, subpixel=False):
+    """
+    Compute SIFT-style descriptors by sampling precomputed gradient maps at the points of each image
+    :param gradients: Gradient maps of shape (no_images, 2, height, width) from batch_gradients
+    :param shapes: numpy array of shape (no_images, no_points, 2)
+    :param subpixel: Sample around the exact points instead of rounding them to the nearest pixel like OpenCV
+    :return: An array of shape (no_images, no_points, 128) containing the descriptor of each point
+    """
+    offsets, weights = descriptor_grid(float(keypoint_size))
+    shapes = np.asarray(shapes, dtype=np.float32)
+    if not subpixel:
+        shapes = np.round(shapes)
+    x = shapes[..., 0, None] + offsets[:, 0].astype(np.float32)
+    y = shapes[..., 1, None] + offsets[:, 1].astype(np.float32)
+    gx, gy = bilinear_sample(gradients, x, y)
+    return gradient_histograms(gx, gy, weights.astype(np.float32))
+
+def batch_descriptors(images, shapes, keypoint_size=keypoint_size, chunk_size=128, subpixel=False):
+    """
+    Pure NumPy replacement for compute_stage_features, describing a whole stack of images in
+    vectorized chunks rather than calling sift.compute once per image
+    :param images: numpy array of shape (no_images, height, width) of preprocessed greyscale images
+    :param shapes: numpy array of shape (no_images, no_points, 2)
+    :param chunk_size: Number of images described at once, bounds the size of the temporaries
+    :param subpixel: Passed on to sample_descriptors
+    :return: An array of shape (no_images, no_points * 128) containing one flattened descriptor row per image
+    """
+    features = []
+    for start in range(0, len(images), chunk_size):
+        gradients = batch_gradients(images[start:start + chunk_size])
+        descriptors = sample_descriptors(gradients, shapes[start:start + chunk_size], keypoint_size, subpixel)
+        features.append(descriptors.reshape(len(descriptors), -1))
+    return np.concatenate(features)
+
+class GradientCache:
+    """
+    Memory bounded cache of the gradient maps of a stack of images. The maps of an image are
+    computed the first time it is described and sampled again at every later cascade stage,
+    evicting the least recently used images once max_bytes is reached
+    """
+    def __init__(self, images, max_bytes=256 * 2 ** 20, keypoint_size=keypoint_size, chunk_size=128):
+        self.images = images
+        self.max_bytes = max_bytes
+        self.keypoint_size = keypoint_size
+        self.chunk_size = chunk_size
+        self.maps = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __getitem__(self, index):
+        if index in self.maps:
+            self.hits += 1
+            self.maps.move_to_end(index)
+            return self.maps[index]
+
+        self.misses += 1
+        gradients = compute_gradients(self.images[index])
+        self.maps[index] = gradients
+        self.nbytes += gradients.nbytes
+        # Evict the least recently used maps, always keeping the newest one
+        while self.nbytes > self.max_bytes and len(self.maps) > 1:
+            self.nbytes -= self.maps.popitem(last=False)[1].nbytes
+        return gradients
+
+    def __call__(self, images, shapes):
+        """
+        Compute the feature matrix for one stage, can be passed as extract to cascaded_regression
+        and regression_predict. Rows of the cached stack, including slices and StackSubsets of it,
+        go through the cache, any other images are described without caching
+        """
+        indices = stack_indices(self.images, images)
+        features = []
+        for start in range(0, len(images), self.chunk_size):
+            stop = min(start + self.chunk_size, len(images))
+            if indices is not None:
+                gradients = np.stack([self[j] for j in indices[start:stop]])
+            else:
+                gradients = batch_gradients(images[start:stop])
+            descriptors = sample_descriptors(gradients, shapes[start:stop], self.keypoint_size)
+            features.append(descriptors.reshape(len(descriptors), -1))
+        return np.concatenate(features)
+
+# Ridge strengths tried when the ridge is chosen automatically, relative to the average eigenvalue of X^T X
+ridge_grid = np.logspace(-6, 3, 19)
+
+class NormalEquations:
+    """
+    Least squares for one cascade stage fitted from a stream of (features, targets) chunks. Only
+    X^T X, X^T Y and the column sums are kept, so memory doesn't grow with the number of samples
+    """
+    def __init__(self):
+        self.count = 0
+        self.xtx = self.xty = self.x_sum = self.y_sum = None
+        self.y_squares = 0.0
+        self.eigen = None
+
+    def add(self, x, y):
+        """
+        Fold in a chunk of features of shape (no_samples, no_features) and targets of shape (no_samples, no_targets)
+        """
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        if self.xtx is None:
+            self.xtx = np.zeros((x.shape[1], x.shape[1]))
+            self.xty = np.zeros((x.shape[1], y.shape[1]))
+            self.x_sum, self.y_sum = np.zeros(x.shape[1]), np.zeros(y.shape[1])
+        self.xtx += x.T @ x
+        self.xty += x.T @ y
+        self.x_sum += x.sum(axis=0)
+        self.y_sum += y.sum(axis=0)
+        self.y_squares += np.sum(np.square(y))
+        self.count += len(x)
+        self.eigen = None
+
+    def centred(self):
+        """
+        :return: The means of the features and targets, and X^T X and X^T Y of the centred features and targets
+        """
+        x_mean, y_mean = self.x_sum / self.count, self.y_sum / self.count
+        xtx = self.xtx - self.count * np.outer(x_mean, x_mean)
+        xty = self.xty - self.count * np.outer(x_mean, y_mean)
+        return x_mean, y_mean, xtx, xty
+
+    def eigendecomposition(self):
+        """
+        Eigenvalues and eigenvectors of the centred X^T X, computed once and shared by every ridge strength
+        :return: The eigenvalues, the eigenvectors as columns, and the centred X^T Y in the eigenvector basis
+        """
+        if self.eigen is None:
+            x_mean, y_mean, xtx, xty = self.centred()
+            values, vectors = np.linalg.eigh(xtx)
+            self.eigen = np.maximum(values, 0), vectors, vectors.T @ xty
+        return self.eigen
+
+    def ridge_scores(self, ridges, x=None, y=None):
+        """
+        Score a grid of ridge strengths in closed form from the one eigendecomposition. Without the
+        samples the generalised cross-validation score is computed from the accumulated sums alone,
+        with them (all of them, as added) the exact leave-one-out error
+        :param ridges: The ridge strengths to score
+        :param x: Optionally the features of every sample, shape (no_samples, no_features)
+        :param y: Their targets, shape (no_samples, no_targets)
+        :return: The mean squared error estimate of each ridge strength, per sample and target
+        """
+        values, vectors, projected = self.eigendecomposition()
+        ridges = np.asarray(ridges, dtype=np.float64)
+        shrink = 1 / (values[:, np.newaxis] + ridges)
+        num_targets = projected.shape[1]
+        if x is None:
+            # Residual sum of squares from the sums, and the effective number of parameters plus the intercept
+            y_squares = self.y_squares - np.sum(np.square(self.y_sum)) / self.count
+            rss = y_squares - np.sum(projected ** 2, axis=1) @ (shrink * (values[:, np.newaxis] + 2 * ridges) * shrink)
+            dof = 1 + values @ shrink
+            return rss / (self.count * num_targets) / np.square(1 - dof / self.count)
+
+        x_mean, y_mean = self.x_sum / self.count, self.y_sum / self.count
+        rotated = (np.asarray(x, dtype=np.float64) - x_mean) @ vectors
+        residuals = np.asarray(y, dtype=np.float64) - y_mean
+        scores = []
+        for column in shrink.T:
+            leverage = 1 / self.count + np.square(rotated) @ column
+            loo = (residuals - (rotated * column) @ projected) / (1 - leverage)[:, np.newaxis]
+            scores.append(np.mean(np.square(loo)))
+        return np.array(scores)
+
+    def select_ridge(self, ridges=None, x=None, y=None):
+        """
+        Pick the ridge strength with the lowest ridge_scores
+        :param ridges: The ridge strengths to try, defaults to ridge_grid times the average eigenvalue of X^T X
+        :return: The best ridge strength, the ridge strengths tried and their scores
+        """
+        if ridges is None:
+            ridges = ridge_grid * np.mean(self.eigendecomposition()[0])
+        scores = self.ridge_scores(ridges, x, y)
+        return ridges[np.argmin(scores)], ridges, scores
+
+    def solve(self, ridge=0.0, dtype=np.float64, x=None, y=None):
+        """
+        Solve for the coefficients and intercept, centring the sums so the intercept isn't regularised.
+        The sums are always accumulated and solved in float64
+        :param ridge: Regularisation strength, 0 gives the minimum norm least squares fit like LinearRegression.
+            'auto' picks it with select_ridge, by exact leave-one-out when x and y are given, otherwise by GCV
+        :param dtype: Floating point type of the returned coefficients
+        :return: A regressor with coef_ of shape (no_targets, no_features), intercept_ of shape (no_targets,)
+            and the ridge_ it was solved with
+        """
+        x_mean, y_mean, xtx, xty = self.centred()
+        if ridge == 'auto':
+            ridge = self.select_ridge(x=x, y=y)[0]
+            values, vectors, projected = self.eigendecomposition()
+            coef = vectors @ (projected / (values + ridge)[:, np.newaxis])
+        elif ridge > 0:
+            coef = np.linalg.solve(xtx + ridge * np.eye(len(xtx)), xty)
+        else:
+            coef = np.linalg.lstsq(xtx, xty, rcond=None)[0]
+        return SimpleNamespace(coef_=np.ascontiguousarray(coef.T, dtype=dtype), intercept_=(y_mean - x_mean @ coef).astype(dtype),
+                               ridge_=ridge)
+
+def stage_chunks(images, shapes, chunk_size, extract):
+    """
+    Compute the features of one stage a chunk of images at a time
+    :return: A generator of (start index, feature matrix of the chunk)
+    """
+    for start in range(0, len(images), chunk_size):
+        # Chunks of a StackSubset stay lazy, so extract can still tell which rows of the stack they are
+        if isinstance(images, StackSubset):
+            chunk = StackSubset(images.stack, images.indices[start:start + chunk_size])
+        else:
+            chunk = images[start:start + chunk_size]
+        yield start, extract(chunk, shapes[start:start + chunk_size])
+
+def training_fingerprint(images, points, init_points, chunk_size=256):
+    """
+    Hash of a training set and its initial points, identifying which checkpoints belong to it
+    """
+    digest = hashlib.sha256()
+    for start in range(0, len(images), chunk_size):
+        digest.update(np.ascontiguousarray(images[start:start + chunk_size]).tobytes())
+    for array in (points, init_points):
+        digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+def feature_settings(extract):
+    """
+    Describe the features an extract function computes, looking through the wrappers which only
+    spread the same work over threads or processes, so checkpoints can tell whether they match
+    :return: A dict of the feature function's name, the keypoint size and any other keyword settings
+    """
+    keywords = {}
+    while True:
+        if isinstance(extract, partial):
+            keywords = {**extract.keywords, **keywords}
+            extract = extract.func
+        elif extract is threaded_features:
+            extract, keywords = keywords.get('extract', compute_stage_features), {}
+        elif isinstance(extract, ProcessPoolFeatures):
+            extract, keywords = extract.extract, {}
+        elif isinstance(extract, GradientCache):
+            return {'features': 'GradientCache', 'keypoint_size': float(extract.keypoint_size)}
+        else:
+            settings = {'features': getattr(extract, '__name__', type(extract).__name__),
+                        'keypoint_size': float(keywords.pop('keypoint_size', keypoint_size))}
+            # Chunking and patch mode don't change the descriptors
+            settings.update({name: repr(value) for name, value in keywords.items() if name not in ('chunk_size', 'patch')})
+            return settings
+
+def write_checkpoint_index(checkpoint_dir, fingerprint, settings, damping_factors):
+    index_path = os.path.join(checkpoint_dir, 'checkpoint.json')
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'settings': settings,
+                   'damping_factors': [float(damping) for damping in damping_factors]}, f)
+    os.replace(index_path + '.tmp', index_path)
+
+def save_checkpoint(checkpoint_dir, stage, regressor, shapes, damping_factors, fingerprint, settings):
+    """
+    Save one trained stage and the training points after its update. checkpoint.json lists the
+    finished stages. The stage is dropped from it before its arrays are overwritten and only added
+    back once they are written, so a crash never leaves a stage listed with arrays it wasn't saved with
+    :param damping_factors: The damping factors of stages 0 to stage
+    :param settings: The solver and feature settings the stages were trained with
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    write_checkpoint_index(checkpoint_dir, fingerprint, settings, damping_factors[:stage])
+    np.save(os.path.join(checkpoint_dir, 'stage%d_coef.npy' % stage), np.asarray(regressor.coef_))
+    np.save(os.path.join(checkpoint_dir, 'stage%d_intercept.npy' % stage), np.asarray(regressor.intercept_))
+    np.save(os.path.join(checkpoint_dir, 'stage%d_shapes.npy' % stage), shapes)
+    write_checkpoint_index(checkpoint_dir, fingerprint, settings, damping_factors)
+
+def load_checkpoint(checkpoint_dir, stage=None, damping_factors=None, fingerprint=None, settings=None):
+    """
+    Load the trained stages of a checkpoint directory, to resume training after them
+    :param stage: Number of stages to load, defaults to all the saved ones
+    :param damping_factors: Only load the leading stages trained with these damping factors
+    :param fingerprint: Load nothing unless the checkpoints were made from this training set
+    :param settings: Load nothing unless the checkpoints were trained with these solver and feature settings
+    :return: The list of regressors, and the training points after the last of them or None if none are loaded
+    """
+    index_path = os.path.join(checkpoint_dir, 'checkpoint.json')
+    if not os.path.exists(index_path):
+        return [], None
+    with open(index_path) as f:
+        index = json.load(f)
+    if fingerprint is not None and index['fingerprint'] != fingerprint:
+        return [], None
+    if settings is not None and index.get('settings') != settings:
+        return [], None
+    num_stages = len(index['damping_factors']) if stage is None else min(stage, len(index['damping_factors']))
+    if damping_factors is not None:
+        # A stage depends on its own damping factor and those of every stage before it
+        matching = [np.isclose(saved, damping) for saved, damping in zip(index['damping_factors'], damping_factors)]
+        num_stages = min(num_stages, (matching + [False]).index(False))
+    if num_stages == 0:
+        return [], None
+    regressors = [SimpleNamespace(coef_=np.load(os.path.join(checkpoint_dir, 'stage%d_coef.npy' % i)),
+                                  intercept_=np.load(os.path.join(checkpoint_dir, 'stage%d_intercept.npy' % i)))
+                  for i in range(num_stages)]
+    return regressors, np.load(os.path.join(checkpoint_dir, 'stage%d_shapes.npy' % (num_stages - 1)))
+
+def cascaded_regression(num_regressors, damping_factors, train_images, train_points, extract=compute_stage_features,
+                        init_points=None, chunk_size=None, ridge=0.0, dtype=compute_dtype, checkpoint_dir=None):
+    """
+    Train the cascade of regressors
+    :param extract: Function computing the (no_images, no_features) feature matrix of one stage
+    :param init_points: The initial prediction of every image, or one per image, defaults to the average training points
+    :param chunk_size: Solve each stage from features streamed a chunk of images at a time with
+        NormalEquations, so memory doesn't grow with the number of images. The features are computed
+        again for the update, instead of being kept
+    :param ridge: Regularisation strength, the stages are solved with NormalEquations when it's set. 'auto'
+        picks it for each stage, see NormalEquations.solve
+    :param dtype: Floating point type of the features, targets and coefficients
+    :param checkpoint_dir: Save every stage and the training points after it here, and resume after
+        the saved stages that were trained on the same data, with the same ridge, features and dtype and
+        the same leading damping factors, e.g. to add stages, change the damping of later stages only or
+        carry on after a crash
+    :return: The list of fitted regressors, one per stage
+    """
+    from sklearn import linear_model
+
     num_images = len(train_images)
-    predicted_train_points = [None] * num_images
+    # Use average points as the initial prediction for every image
+    if init_points is None:
+        init_points = np.mean(train_points, axis=0)
+    train_points = np.asarray(train_points, dtype=dtype)
+    predicted_train_points = np.broadcast_to(init_points, (num_images,) + np.shape(init_points)[-2:]).astype(dtype)
     regressors = []
+    if checkpoint_dir is not None:
+        fingerprint = training_fingerprint(train_images, train_points, init_points)
+        settings = {'ridge': ridge if ridge == 'auto' else float(ridge), 'dtype': np.dtype(dtype).name,
+                    **feature_settings(extract)}
+        regressors, shapes = load_checkpoint(checkpoint_dir, num_regressors, damping_factors, fingerprint, settings)
+        if shapes is not None:
+            predicted_train_points = shapes.astype(dtype)
 
-    for i in range(num_regressors):
-        x_train, y_train = [], []
+    for i in range(len(regressors), num_regressors):
+        delta = (train_points - predicted_train_points).reshape(num_images, -1)
+        y_train = damping_factors[i] * delta
 
-        for j in range(num_images):
-            img = train_images[j]
+        if chunk_size is None and ridge == 0:
+            # Compute SIFT descriptors based on the current prediction, only once per stage
+            # since the points don't move until the model has been trained
+            x_train = extract(train_images, predicted_train_points).astype(dtype, copy=False)
 
-            # If no previous prediction, use average points as intial prediction
-            if predicted_train_points[j] is None:
-                predicted_train_points[j] = average_points.copy()
-            
-            # Compute SIFT descriptors based on the current prediction
-            descriptors = compute_descriptors(img, predicted_train_points[j])
-            delta = (train_points[j] - predicted_train_points[j]).flatten()
+            # Train a linear regression model using the descriptors as input and delta value as target
+            model = linear_model.LinearRegression()
+            model.fit(x_train, y_train)
+            regressors.append(model) # Then append to the list of regressors
 
-            x_train.append(descriptors.flatten())
-            y_train.append(damping_factors[i] * delta)
+            # Now update predictions for all images, reusing the same stage features
+            delta = model.predict(x_train).reshape(predicted_train_points.shape)
+        else:
+            # Accumulate the normal equations over the chunks, then solve the small system
+            step = chunk_size or num_images
+            normal = NormalEquations()
+            for start, x_train in stage_chunks(train_images, predicted_train_points, step, extract):
+                normal.add(x_train, y_train[start:start + len(x_train)])
+            if step >= num_images:
+                # All the features are in memory, so an automatic ridge can use exact leave-one-out
+                model = normal.solve(ridge, dtype, x_train, y_train)
+            else:
+                model = normal.solve(ridge, dtype)
+            regressors.append(model)
 
-        x_train = np.array(x_train) # make sure they are np arrays to avoid errors
-        y_train = np.array(y_train)
+            if step >= num_images:
+                delta = stage_predict(model, x_train.astype(dtype, copy=False))
+            else:
+                delta = np.concatenate([stage_predict(model, x_train.astype(dtype, copy=False)) for start, x_train in
+                                        stage_chunks(train_images, predicted_train_points, step, extract)])
+            delta = delta.reshape(predicted_train_points.shape)
 
-        # Train a linear regression model using the descriptors as input and delta value as target
-        model = linear_model.LinearRegression()
-        model.fit(x_train, y_train)
-        regressors.append(model) # Then append to the list of regressors
+        # Update prediction using model output and dampening factor
+        predicted_train_points = predicted_train_points + damping_factors[i] * delta
+        if checkpoint_dir is not None:
+            save_checkpoint(checkpoint_dir, i, regressors[-1], predicted_train_points, damping_factors[:i + 1],
+                            fingerprint, settings)
 
-        # Now update predictions for all images
-        for k in range(num_images):
-            img = train_images[k]
-            descriptors = compute_descriptors(img, predicted_train_points[k])
+    return regressors
+
+def stage_predict(regressor, x_feat):
+    """
+    Apply one trained stage to a whole feature matrix with a single matrix multiply
+    :param regressor: A fitted linear model with coef_ and intercept_
+    :param x_feat: numpy array of shape (no_images, no_features), its dtype is used for the multiply
+    :return: An array of shape (no_images, no_points * 2) containing the predicted delta of each image
+    """
+    return x_feat @ regressor.coef_.T.astype(x_feat.dtype, copy=False) + regressor.intercept_.astype(x_feat.dtype, copy=False)
+
+class StageRegressor:
+    """
+    One stage of a trained cascade for prediction, stored as just a contiguous (no_features, no_points * 2)
+    weight matrix and bias with the stage's damping factor folded in, so a stage is applied as
+    shapes += features @ weights + bias without sklearn
+    """
+    def __init__(self, weights, bias, dtype=compute_dtype):
+        self.weights = np.ascontiguousarray(weights, dtype=dtype)
+        self.bias = np.ascontiguousarray(bias, dtype=dtype)
 
-            x_feat = descriptors.flatten().reshape(1, -1) # make sure to reshape 
-            delta = model.predict(x_feat).reshape(-1, 2)
+    @classmethod
+    def from_regressor(cls, regressor, damping, dtype=compute_dtype):
+        """
+        Fold a damping factor into a fitted linear model with coef_ and intercept_, e.g. LinearRegression
+        """
+        return cls(damping * np.asarray(regressor.coef_, dtype=np.float64).T,
+                   damping * np.asarray(regressor.intercept_, dtype=np.float64), dtype)
 
-            # Update prediction using model output and dampening factor
-            predicted_train_points[k] = predicted_train_points[k] + damping_factors[i] * delta
+    def predict(self, x_feat):
+        """
+        :param x_feat: numpy array of shape (no_images, no_features)
+        :return: An array of shape (no_images, no_points * 2) containing the damped update of each image
+        """
+        return x_feat @ self.weights.astype(x_feat.dtype, copy=False) + self.bias.astype(x_feat.dtype, copy=False)
 
-    return regressors
+def stage_regressors(regressors, damping_factors, dtype=compute_dtype):
+    """
+    Convert the regressors of cascaded_regression to StageRegressors, folding in their damping factors.
+    StageRegressors are passed through as they are, their damping is already folded in
+    """
+    return [regressor if isinstance(regressor, StageRegressor) else StageRegressor.from_regressor(regressor, damping, dtype)
+            for regressor, damping in zip(regressors, damping_factors)]
+
+def regression_predict(images, regressors, damping_factors, init_points, extract=compute_stage_features, dtype=compute_dtype,
+                       tol=None):
+    """
+    Predict the points of a stack of images, refining every image at once at each stage of the cascade
+    :param images: The preprocessed images
+    :param regressors: The stages, fitted models from cascaded_regression or StageRegressors
+    :param damping_factors: The damping factor of each stage. It is folded into the fitted models here,
+        StageRegressors already have theirs folded in and ignore it
+    :param init_points: The initial points of every image, shape (no_points, 2), or one per image
+    :param extract: Function computing the (no_images, no_features) feature matrix of one stage
+    :param dtype: Floating point type of the features and points
+    :param tol: If set, an image skips the remaining stages once a stage moves its points by less
+        than this, see early_exit_predict
+    :return: numpy array of shape (no_images, no_points, 2) with the predicted points
+    """
+    if tol is not None:
+        # Let converged images skip the remaining stages
+        return early_exit_predict(images, regressors, damping_factors, init_points, tol, extract, dtype)[0]
+    num_images = len(images)
+    # Every image starts from the initial points, normally the average training points, or from its own initial points
+    predicted_points = np.broadcast_to(init_points, (num_images,) + np.shape(init_points)[-2:]).astype(dtype)
+    # Loop through model iterations and refine the predicted points of every image at once
+    for stage in stage_regressors(regressors, damping_factors, dtype):
+        x_feat = extract(images, predicted_points).astype(dtype, copy=False)
+
+        # increment by the damped delta value
+        predicted_points = predicted_points + stage.predict(x_feat).reshape(predicted_points.shape)
+
+    return predicted_points
+
+def early_exit_predict(images, regressors, damping_factors, init_points, tol, extract=compute_stage_features,
+                       dtype=compute_dtype):
+    """
+    regression_predict where an image leaves the cascade once a stage moves its points by less than
+    tol, so later stages only describe and update the images which haven't converged yet
+    :param tol: Smallest norm of a stage's update of all the points of an image that keeps it in the cascade
+    :return: The predicted points, and the number of stages run on each image
+    """
+    num_images = len(images)
+    predicted_points = np.broadcast_to(init_points, (num_images,) + np.shape(init_points)[-2:]).astype(dtype)
+    stages_run = np.zeros(num_images, dtype=int)
+    active = np.arange(num_images)
+    for stage in stage_regressors(regressors, damping_factors, dtype):
+        if len(active) == 0:
+            break
+        x_feat = extract(subset(images, active), predicted_points[active]).astype(dtype, copy=False)
+        update = stage.predict(x_feat).reshape(len(active), -1, 2)
+        predicted_points[active] += update
+        stages_run[active] += 1
+        active = active[np.linalg.norm(update.reshape(len(active), -1), axis=1) >= tol]
+    return predicted_points, stages_run
+
+def benchmark_early_exit(images, points, regressors, damping_factors, init_points, tols=(None, 0.01, 0.1, 0.5, 1.0, 2.0, 5.0)):
+    """
+    Trade accuracy against throughput for a range of early exit thresholds
+    :param images: The preprocessed images to predict on
+    :param points: The ground truth points of the images
+    :param tols: The thresholds to try, None runs every stage on every image
+    :return: A list of (tol, average stages per image, mean squared error, images/second)
+    """
+    results = []
+    for tol in tols:
+        start_time = time.perf_counter()
+        if tol is None:
+            predictions = regression_predict(images, regressors, damping_factors, init_points)
+            stages_run = np.full(len(images), len(regressors))
+        else:
+            predictions, stages_run = early_exit_predict(images, regressors, damping_factors, init_points, tol)
+        elapsed = time.perf_counter() - start_time
+        results.append((tol, np.mean(stages_run), np.mean(np.square(points - predictions)), len(images) / elapsed))
+        print("tol %s: %.2f stages per image, MSE %f, %.1f images/s" % ((tol,) + results[-1][1:]))
+    return results
+
+def perturb_shapes(shape, num_shapes, translation=0.0, scale=0.0, rotation=0.0, random_state=None):
+    """
+    Randomly move, resize and rotate a shape about its centre
+    :param shape: The points to perturb, normally the average training points
+    :param translation: Largest shift in x and y, in pixels
+    :param scale: Largest relative change in size
+    :param rotation: Largest rotation, in radians
+    :return: num_shapes perturbed copies of shape
+    """
+    rng = np.random.default_rng(random_state)
+    angles = rng.uniform(-rotation, rotation, num_shapes)
+    scales = 1 + rng.uniform(-scale, scale, num_shapes)
+    shifts = rng.uniform(-translation, translation, (num_shapes, 1, 2))
+    cos, sin = np.cos(angles) * scales, np.sin(angles) * scales
+    transforms = np.stack([np.stack([cos, sin], axis=-1), np.stack([-sin, cos], axis=-1)], axis=1)
+    centre = np.mean(shape, axis=0)
+    return (shape - centre) @ transforms + centre + shifts
+
+def initial_shapes(init_points, num_inits, translation=2.0, scale=0.1, rotation=np.radians(10), random_state=0):
+    """
+    init_points followed by num_inits - 1 perturbed copies of it, see perturb_shapes
+    """
+    inits = perturb_shapes(init_points, num_inits, translation, scale, rotation, random_state)
+    inits[0] = init_points
+    return inits
+
+def multi_init_predict(images, regressors, damping_factors, init_points, num_inits=8, extract=compute_stage_features,
+                       dtype=compute_dtype, **perturbation):
+    """
+    regression_predict from several perturbed initial shapes per image, fused by the median of each point.
+    All the images and initial shapes go through the cascade as one batch, and each image is described
+    once per stage with the points of all its shapes, so the image is only prepared by sift.compute once
+    :param num_inits: Number of initial shapes per image, the first is init_points itself
+    :param extract: Function computing the feature matrix of one stage, given every shape's points of an image at once
+    :param perturbation: How far the initial shapes are perturbed, see initial_shapes
+    :return: The predicted points
+    """
+    num_images = len(images)
+    inits = initial_shapes(init_points, num_inits, **perturbation)
 
-def regression_predict(images, regressors, damping_factors):
+    def grouped_extract(repeated, shapes):
+        # Rows of an image's shapes are consecutive, so one row of all its points splits back into them
+        return extract(images, shapes.reshape(num_images, -1, 2)).reshape(len(shapes), -1)
+
+    repeated = StackSubset(images, np.repeat(np.arange(num_images), num_inits))
+    predictions = regression_predict(repeated, regressors, damping_factors, np.tile(inits, (num_images, 1, 1)),
+                                     grouped_extract, dtype)
+    return np.median(predictions.reshape((num_images, num_inits) + predictions.shape[1:]), axis=1)
+
+def benchmark_multi_init(images, points, regressors, damping_factors, init_points, num_inits=(1, 4, 8, 16)):
+    """
+    Compare the error and time of predicting from more initial shapes per image, in one batch and as separate calls
+    :param images: The preprocessed images to predict on
+    :param points: The ground truth points of the images
+    :param num_inits: The numbers of initial shapes to try
+    :return: A list of (initial shapes, mean squared error, batched seconds, separate calls seconds)
+    """
+    results = []
+    for inits in num_inits:
+        start_time = time.perf_counter()
+        predictions = multi_init_predict(images, regressors, damping_factors, init_points, inits)
+        batched_time = time.perf_counter() - start_time
+
+        # The same work as one regression_predict call per initial shape
+        start_time = time.perf_counter()
+        for shape in initial_shapes(init_points, inits):
+            regression_predict(images, regressors, damping_factors, shape)
+        separate_time = time.perf_counter() - start_time
+
+        results.append((inits, np.mean(np.square(points - predictions)), batched_time, separate_time))
+        print("%d initial shapes: MSE %f, %.2fs batched, %.2fs as separate calls" % results[-1])
+    return results
+
+def regression_predict_loop(images, regressors, damping_factors, init_points):
+    """
+    Reference version of regression_predict which refines one image at a time with the fitted sklearn
+    models, kept for benchmarking
+    """
     predictions = []
     for img in images:
-        predicted_points = average_points.copy()
+        predicted_points = init_points.copy()
         # Loop through model iterations and refine the predicted points
         for i in range(len(regressors)):
             regressor = regressors[i]
@@ -158,46 +1110,1009 @@ def regression_predict(images, regressors, damping_factors):
     
     return(np.array(predictions))
 
-# Get a train/test split
-train_images_split, test_images_split, train_points_split, test_points_split = train_test_split(
-    train_images, train_points, test_size=0.2, random_state=69
-)
+def benchmark_predict(images, regressors, damping_factors, init_points, repeats=3):
+    """
+    Compare the throughput of the batched and per-image prediction paths
+    :param images: The preprocessed images to predict on
+    :param repeats: Number of timed runs, the best one is reported
+    :return: A dict mapping the name of each path to its images/second
+    """
+    results, outputs = {}, {}
+    for name, predict in [('loop', regression_predict_loop), ('batched', regression_predict)]:
+        best, outputs[name] = best_time(lambda: predict(images, regressors, damping_factors, init_points), repeats)
+        results[name] = len(images) / best
+        print("%s: %.1f images/s" % (name, results[name]))
+    print("max difference:", np.max(np.abs(outputs['loop'] - outputs['batched'])))
+    return results
+
+def benchmark_preprocess(images, scale=resize_scale, repeats=3):
+    """
+    Compare the throughput and peak memory of preprocess and preprocess_batch
+    :param images: The raw images to preprocess
+    :param scale: The resize scale
+    :param repeats: Number of timed runs, the best one is reported
+    :return: A dict mapping the name of each path to its images/second
+    """
+    reference = preprocess(images, scale)
+    results = {}
+    paths = [('list', lambda: preprocess(images, scale)),
+             ('preallocated', lambda: preprocess_batch(images, scale)),
+             ('vectorized', lambda: preprocess_batch(images, scale, vectorized=True))]
+    for name, run in paths:
+        best = best_time(run, repeats)[0]
+        # Measure the peak memory separately, tracing slows the run down
+        tracemalloc.start()
+        output = run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert np.array_equal(output, reference), '%s preprocessing differs from preprocess' % name
+        results[name] = len(images) / best
+        print("%s: %.1f images/s, peak %.1f MB" % (name, results[name], peak / 2 ** 20))
+    return results
+
+def benchmark_descriptors(images, shapes, repeats=3):
+    """
+    Compare the per-image OpenCV descriptors with the vectorized NumPy ones
+    :param images: The preprocessed images to describe
+    :param shapes: numpy array of shape (no_images, no_points, 2) of points to describe
+    :param repeats: Number of timed runs, the best one is reported
+    :return: A dict mapping the name of each path to its images/second
+    """
+    cache = GradientCache(images)
+    results, outputs = {}, {}
+    for name, extract in [('opencv', compute_stage_features), ('numpy', batch_descriptors), ('numpy cached', cache)]:
+        best, outputs[name] = best_time(lambda: extract(images, shapes), repeats)
+        results[name] = len(images) / best
+        print("%s: %.1f images/s" % (name, results[name]))
+    a, b = outputs['opencv'].reshape(-1, 128), outputs['numpy'].reshape(-1, 128)
+    a, b = a - a.mean(axis=1, keepdims=True), b - b.mean(axis=1, keepdims=True)
+    correlation = np.sum(a * b, axis=1) / np.sqrt(np.sum(a * a, axis=1) * np.sum(b * b, axis=1))
+    print("median descriptor correlation with opencv:", np.median(correlation))
+    return results
+
+# A trained cascade together with everything needed to run it on new images
+Cascade = namedtuple('Cascade', ['regressors', 'damping_factors', 'average_points', 'resize_scale', 'keypoint_size'])
+
+def save_cascade(path, regressors, damping_factors, average_points, resize_scale=resize_scale, keypoint_size=keypoint_size,
+                 dtype=compute_dtype):
+    """
+    Save a trained cascade as a directory of .npy files plus a small json file of settings
+    :param path: Directory to save the cascade in, created if needed
+    :param regressors: The fitted stage regressors from cascaded_regression
+    :param damping_factors: The damping factor of each stage, folded into the saved weights
+    :param average_points: numpy array of shape (no_points, 2) used as the initial prediction
+    :param dtype: Floating point type the weights and average points are stored as
+    """
+    os.makedirs(path, exist_ok=True)
+    stages = stage_regressors(regressors, damping_factors, dtype)
+    np.save(os.path.join(path, 'weights.npy'), np.stack([stage.weights for stage in stages]))
+    np.save(os.path.join(path, 'bias.npy'), np.stack([stage.bias for stage in stages]))
+    np.save(os.path.join(path, 'damping_factors.npy'), np.asarray(damping_factors, dtype=np.float64))
+    np.save(os.path.join(path, 'average_points.npy'), np.asarray(average_points, dtype=dtype))
+    with open(os.path.join(path, 'cascade.json'), 'w') as f:
+        json.dump({'num_regressors': len(regressors), 'resize_scale': resize_scale, 'keypoint_size': keypoint_size}, f)
+
+def load_cascade(path, mmap_mode='r'):
+    """
+    Load a cascade saved by save_cascade, memory-mapping the weights so no sklearn or
+    retraining is needed to predict with it
+    :param path: Directory the cascade was saved in
+    :param mmap_mode: Passed on to np.load, None reads the weights into memory
+    :return: A Cascade of StageRegressors which can be passed straight to regression_predict
+    """
+    with open(os.path.join(path, 'cascade.json')) as f:
+        settings = json.load(f)
+    damping_factors = np.load(os.path.join(path, 'damping_factors.npy')).tolist()
+    if os.path.exists(os.path.join(path, 'weights.npy')):
+        weights = np.load(os.path.join(path, 'weights.npy'), mmap_mode=mmap_mode)
+        bias = np.load(os.path.join(path, 'bias.npy'), mmap_mode=mmap_mode)
+        regressors = [StageRegressor(weights[i], bias[i], weights.dtype) for i in range(settings['num_regressors'])]
+    else:
+        # Cascades saved before the damping was folded in keep the fitted coefficients
+        coef = np.load(os.path.join(path, 'coef.npy'), mmap_mode=mmap_mode)
+        intercept = np.load(os.path.join(path, 'intercept.npy'), mmap_mode=mmap_mode)
+        regressors = stage_regressors([SimpleNamespace(coef_=coef[i], intercept_=intercept[i])
+                                       for i in range(settings['num_regressors'])], damping_factors, coef.dtype)
+    return Cascade(regressors,
+                   damping_factors,
+                   np.load(os.path.join(path, 'average_points.npy')),
+                   settings['resize_scale'],
+                   settings['keypoint_size'])
+
+def check_cascade(cascade):
+    """
+    Make sure a loaded cascade was trained with the same settings the descriptors are computed with
+    """
+    if (cascade.resize_scale, cascade.keypoint_size) != (resize_scale, keypoint_size):
+        raise ValueError("cascade was trained with resize_scale %g and keypoint_size %g, not %g and %g" % (
+            cascade.resize_scale, cascade.keypoint_size, resize_scale, keypoint_size))
+
+def image_chunks(images, chunk_size):
+    """
+    Split images into arrays of at most chunk_size images, slicing arrays (so memmaps are only
+    paged in a chunk at a time) and stacking the images of any other iterable
+    """
+    if hasattr(images, 'shape'):
+        for start in range(0, len(images), chunk_size):
+            yield images[start:start + chunk_size]
+    else:
+        iterator = iter(images)
+        while True:
+            chunk = list(islice(iterator, chunk_size))
+            if not chunk:
+                return
+            yield np.stack(chunk)
+
+def predict_stream(images, cascade, chunk_size=256, extract=compute_stage_features, dtype=compute_dtype):
+    """
+    Predict the points of any number of raw images with constant memory. Images are taken a chunk
+    at a time, and the next chunk is preprocessed on a background thread while the cascade runs
+    on the current one
+    :param images: Raw RGB images, a (memory-mapped) array or any iterable of images such as video frames
+    :param cascade: A Cascade, e.g. from load_cascade
+    :param chunk_size: Number of images preprocessed and refined together
+    :return: A generator of (index, points) in input order, with the points at the original image size
+    """
+    check_cascade(cascade)
+    scale = cascade.resize_scale
+    buffers = [None, None]
+
+    def prepare(k, chunk):
+        # Alternate between two preallocated buffers, one in use by the cascade and one being filled
+        height, width = chunk.shape[1:3]
+        shape = (chunk_size, int(width * scale), int(height * scale))
+        if buffers[k % 2] is None or buffers[k % 2].shape != shape:
+            buffers[k % 2] = np.empty(shape, dtype=np.uint8)
+        return preprocess_batch(chunk, scale, out=buffers[k % 2][:len(chunk)])
+
+    chunks = enumerate(image_chunks(images, chunk_size))
+    with ThreadPoolExecutor(1) as executor:
+        pending = next((executor.submit(prepare, k, chunk) for k, chunk in chunks), None)
+        start = 0
+        while pending is not None:
+            images_preprocessed = pending.result()
+            pending = next((executor.submit(prepare, k, chunk) for k, chunk in chunks), None)
+            predictions = regression_predict(images_preprocessed, cascade.regressors, cascade.damping_factors,
+                                             cascade.average_points, extract, dtype)
+            for i, points in enumerate(predictions / scale):
+                yield start + i, points
+            start += len(predictions)
+
+def window_similarity(image, points, reference, reference_points, radius):
+    """
+    Compare the appearance of two images around corresponding points
+    :param image: A preprocessed frame
+    :param points: numpy array of shape (no_points, 2) of points in image
+    :param reference: The preprocessed frame to compare against
+    :param reference_points: The corresponding points in reference
+    :param radius: Half the side of the square window compared around each point
+    :return: The mean correlation of the windows, from -1 to 1. Points whose window leaves either
+        frame are skipped, and 1 is returned when every point is skipped
+    """
+    correlations = []
+    for (x, y), (rx, ry) in zip(np.round(points).astype(int), np.round(reference_points).astype(int)):
+        if min(x, y, rx, ry) < radius or max(x, rx) + radius >= image.shape[1] or max(y, ry) + radius >= image.shape[0]:
+            continue
+        a = image[y - radius:y + radius + 1, x - radius:x + radius + 1].astype(np.float64)
+        b = reference[ry - radius:ry + radius + 1, rx - radius:rx + radius + 1].astype(np.float64)
+        a, b = a - a.mean(), b - b.mean()
+        correlations.append(np.sum(a * b) / (np.sqrt(np.sum(a * a) * np.sum(b * b)) + 1e-9))
+    return np.mean(correlations) if correlations else 1.0
+
+def tracking_lost(points, previous_points, image_shape, offset, similarities, max_offset, max_scale_change,
+                  min_similarity):
+    """
+    Check whether a warm started prediction still looks like it's on a face
+    :param points: The points predicted for this frame
+    :param previous_points: The points the prediction was started from
+    :param image_shape: (height, width) of the preprocessed frame
+    :param offset: Largest norm of the warm stages' updates with their damping divided out, i.e. how far
+        the stages still estimate the points are from the face, independent of the damping schedule
+    :param similarities: window_similarity of the frame against the previous frame at the previous
+        points, which drops when the face jumps between frames, and against the frame tracking was last
+        initialised on at the new points, which drops as the points drift off the landmarks
+    :return: True if the frame should be predicted again from the mean shape
+    """
+    height, width = image_shape
+    if np.any(points < 0) or np.any(points[:, 0] >= width) or np.any(points[:, 1] >= height):
+        return True
+    if offset > max_offset or min(similarities) < min_similarity:
+        return True
+    # The face can't suddenly change size between frames
+    size = np.linalg.norm(points - points.mean(axis=0))
+    previous_size = np.linalg.norm(previous_points - previous_points.mean(axis=0))
+    return not 1 / max_scale_change <= size / previous_size <= max_scale_change
+
+def track(frames, cascade, last_stages=2, max_offset=2.0, max_scale_change=1.5, min_similarity=0.5,
+          window_radius=None, reinit_every=None, extract=compute_stage_features, dtype=compute_dtype):
+    """
+    Track the points through an ordered stream of frames. Each frame starts from the previous frame's
+    points and only runs the last few stages of the cascade. The first frame, and any frame where the
+    warm started points fail tracking_lost, runs the whole cascade from the mean shape
+    :param frames: Raw RGB frames in order, any iterable such as a video reader
+    :param cascade: A Cascade, e.g. from load_cascade
+    :param last_stages: Number of stages to run from the previous frame's points, at least 1. More than
+        the cascade has runs all of them
+    :param max_offset: Largest undamped update of a warm stage, in preprocessed pixels, before tracking is lost
+    :param max_scale_change: Largest change in the size of the shape between frames before tracking is lost
+    :param min_similarity: Smallest window_similarity to the previous frame, and to the frame tracking was
+        initialised on, before tracking is lost
+    :param window_radius: Half the side of the windows compared, defaults to twice the keypoint size
+    :param reinit_every: Also run the whole cascade every this many frames (at least 1), to bound slow
+        drift. None only reinitialises when tracking is lost
+    :return: A generator of (points, reinitialised) per frame, with the points at the original frame size
+    """
+    check_cascade(cascade)
+    if last_stages < 1:
+        raise ValueError("last_stages must be at least 1, not %d" % last_stages)
+    if reinit_every is not None and reinit_every < 1:
+        raise ValueError("reinit_every must be at least 1 or None, not %d" % reinit_every)
+    scale = cascade.resize_scale
+    stages = stage_regressors(cascade.regressors, cascade.damping_factors, dtype)[-last_stages:]
+    damping_factors = list(cascade.damping_factors)[-last_stages:]
+    radius = window_radius or int(round(2 * cascade.keypoint_size))
+    buffer = None
+    previous_image = previous_points = None
+    template = template_points = None
+    for k, frame in enumerate(frames):
+        height, width = frame.shape[:2]
+        shape = (1, int(width * scale), int(height * scale))
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=np.uint8)
+        image = preprocess_batch(frame[np.newaxis], scale, out=buffer)
+
+        reinitialised = previous_points is None or (reinit_every is not None and k % reinit_every == 0)
+        if not reinitialised:
+            points = previous_points[np.newaxis].astype(dtype)
+            offset = 0.0
+            for stage, damping in zip(stages, damping_factors):
+                x_feat = extract(image, points).astype(dtype, copy=False)
+                update = stage.predict(x_feat).reshape(points.shape)
+                points = points + update
+                # The update is the stage's estimate of the remaining offset, damped twice
+                if damping > 0:
+                    offset = max(offset, np.linalg.norm(update) / damping ** 2)
+            similarities = (window_similarity(image[0], previous_points, previous_image, previous_points, radius),
+                            window_similarity(image[0], points[0], template, template_points, radius))
+            reinitialised = tracking_lost(points[0], previous_points, image.shape[1:], offset, similarities,
+                                          max_offset, max_scale_change, min_similarity)
+        if reinitialised:
+            points = regression_predict(image, cascade.regressors, cascade.damping_factors, cascade.average_points,
+                                        extract, dtype)
+            template, template_points = image[0].copy(), points[0]
+        # The buffer is overwritten by the next frame
+        previous_image, previous_points = image[0].copy(), points[0]
+        yield previous_points / scale, reinitialised
 
-# Preprocess and resize all images and points
-train_imgs_split_preprocessed = preprocess(train_images_split, resize_scale)
-train_pts_split_resized = resize_points(train_points_split, resize_scale)
-test_imgs_split_preprocessed = preprocess(test_images_split, resize_scale)
-test_pts_split_resized = resize_points(test_points_split, resize_scale)
+def pan_frames(image, points, num_frames, amplitude=(16, 8), period=50):
+    """
+    Fake a video by panning an image back and forth, for benchmarking tracking without a labelled video
+    :param image: A raw RGB image
+    :param points: The ground truth points of the image
+    :param amplitude: Largest (x, y) shift of the image in pixels
+    :param period: Number of frames in one back and forth movement
+    :return: A generator of (frame, points)
+    """
+    for k in range(num_frames):
+        shift = np.round(np.multiply(amplitude, np.sin(2 * np.pi * k / period))).astype(int)
+        yield np.roll(image, (shift[1], shift[0]), axis=(0, 1)), points + shift
+
+def benchmark_tracking(image, points, cascade, num_frames=200, last_stages=(1, 2, 3), reinit_every=None):
+    """
+    Compare the per frame latency and error of tracking a panned image against running the whole cascade on every frame
+    :param image: A raw RGB image to pan back and forth
+    :param points: The ground truth points of the image
+    :param last_stages: The numbers of warm started stages to try
+    :return: A list of (last stages, ms per frame, mean squared error, number of reinitialisations)
+    """
+    results = []
+    for stages in (None,) + tuple(last_stages):
+        frames, frame_points = zip(*pan_frames(image, points, num_frames))
+        start_time = time.perf_counter()
+        if stages is None:
+            predictions = [points for _, points in predict_stream(frames, cascade, chunk_size=1)]
+            reinitialised = [True] * num_frames
+        else:
+            predictions, reinitialised = zip(*track(frames, cascade, stages, reinit_every=reinit_every))
+        elapsed = time.perf_counter() - start_time
+        # The points are compared at the preprocessed size like the other benchmarks
+        error = np.mean(np.square(np.multiply(np.subtract(frame_points, predictions), cascade.resize_scale)))
+        results.append((stages, 1000 * elapsed / num_frames, error, sum(reinitialised)))
+        print("%s stages: %.2fms per frame, MSE %f, %d reinitialisations" %
+              ((stages or 'all', ) + results[-1][1:]))
+    return results
 
+# Default data files and settings of the script
+train_file = 'face_alignment_training_images.npz'
+test_file = 'face_alignment_test_images.npz'
 num_regressors = 5
-damping_factors = np.linspace(1.0, 0.1, num_regressors).tolist()
-print("damping factors:", damping_factors)
-
-# run cascaded regression with the train/test split
-regressors = cascaded_regression(num_regressors, damping_factors, train_imgs_split_preprocessed, train_pts_split_resized)
-predictions = regression_predict(test_imgs_split_preprocessed, regressors, damping_factors)
-print("predictions shape:", predictions.shape)
-
-# Calculate distance between the predictions and the ground truth points on the test split
-distances = euclid_dist(predictions, test_pts_split_resized)
-print("Distances:", distances)
-
-# Calculate the mean squared error
-mse = mean_squared_error(test_pts_split_resized.flatten(), predictions.flatten())
-print("Mean Squared Error:", mse)
-
-# Final predictions
-# run cascaded regression with the full train images and train points
-regressors = cascaded_regression(num_regressors, damping_factors, train_images_preprocessed, train_points_resized)
-# then get predictions on all test images
-test_predictions = regression_predict(test_images_preprocessed, regressors, damping_factors)
-print("final predictions shape:", test_predictions.shape)
-
-# Resize the final prediction points back to the original size and save to csv
-test_predictions_resized = resize_points(test_predictions, 1 / resize_scale)
-save_as_csv(test_predictions_resized)
-
-# finally I can visualise the original size predictions with the original test images
-for i in range(10):
-    idx = np.random.randint(0, test_images.shape[0])
-    visualise_pts(test_images[idx], test_predictions_resized[idx])
\ No newline at end of file
+test_size = 0.2
+split_seed = 69
+
+def convert_dataset(npz_path, out_dir, chunk_bytes=64 * 2 ** 20):
+    """
+    Convert a .npz dataset to a directory of uncompressed .npy files, images.npy and points.npy,
+    which load_data can memory-map. Arrays are copied through in chunks so the conversion
+    itself doesn't need the whole image array in memory
+    :param npz_path: Path to a .npz file with 'images' and optionally 'points'
+    :param out_dir: Directory to write the .npy files to, created if needed
+    :param chunk_bytes: Roughly how much of an array is copied at a time
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    with zipfile.ZipFile(npz_path) as archive:
+        for name in ('images', 'points'):
+            if name + '.npy' not in archive.namelist():
+                continue
+            out_path = os.path.join(out_dir, name + '.npy')
+            with archive.open(name + '.npy') as f:
+                if np.lib.format.read_magic(f) == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+                if dtype.hasobject or fortran_order or len(shape) == 0:
+                    # Can't be streamed, so load this array the normal way
+                    np.save(out_path, np.ascontiguousarray(np.load(npz_path, allow_pickle=True)[name]))
+                    continue
+                out = np.lib.format.open_memmap(out_path, mode='w+', dtype=dtype, shape=shape)
+                rows = max(1, chunk_bytes // max(1, out[:1].nbytes))
+                for start in range(0, shape[0], rows):
+                    chunk = out[start:start + rows]
+                    chunk[...] = np.frombuffer(f.read(chunk.nbytes), dtype=dtype).reshape(chunk.shape)
+                out.flush()
+                del out
+
+def load_data(path):
+    """
+    Load the images, and the points if there are any, of a dataset
+    :param path: Path to a .npz file with 'images' and optionally 'points', or a directory made
+        by convert_dataset whose arrays are memory-mapped and paged in as they are used
+    :return: The images, and the points or None for a test set
+    """
+    if os.path.isdir(path):
+        images = np.load(os.path.join(path, 'images.npy'), mmap_mode='r')
+        points_path = os.path.join(path, 'points.npy')
+        points = np.load(points_path, mmap_mode='r') if os.path.exists(points_path) else None
+        return images, points
+    data = np.load(path, allow_pickle=True)
+    points = data['points'] if 'points' in data else None
+    return data['images'], points
+
+# Where preprocessed datasets are cached, and a version to bump whenever preprocessing changes
+cache_dir = '.preprocess_cache'
+preprocess_version = 1
+
+def file_hash(path, cache_dir=cache_dir):
+    """
+    sha256 of a file's contents. Hashes are remembered by path, size and modification time
+    so an unchanged file is only read once
+    """
+    stat = os.stat(path)
+    index_path = os.path.join(cache_dir, 'hashes.json')
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    key = '%s:%d:%d' % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in index:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                digest.update(block)
+        index[key] = digest.hexdigest()
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(index_path + '.%d' % os.getpid(), 'w') as f:
+            json.dump(index, f)
+        os.replace(index_path + '.%d' % os.getpid(), index_path)
+    return index[key]
+
+def cached_preprocess(path, scale=resize_scale, cache_dir=cache_dir):
+    """
+    Load and preprocess a dataset, reusing the result of an earlier run when the same data has
+    already been preprocessed with the same settings. Entries are keyed on the hash of the source
+    files, the scale and preprocess_version, and are memory-mapped rather than read
+    :param path: A .npz file or a directory made by convert_dataset
+    :param scale: The resize scale
+    :return: The preprocessed images and the resized points, or None for a test set
+    """
+    sources = [os.path.join(path, name) for name in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+    sources = [source for source in sources if source.endswith(('.npy', '.npz'))]
+    key = hashlib.sha256(json.dumps({'sources': [file_hash(source, cache_dir) for source in sources],
+                                     'scale': scale, 'version': preprocess_version}).encode()).hexdigest()[:32]
+    entry = os.path.join(cache_dir, key)
+
+    if not os.path.exists(entry):
+        images, points = load_data(path)
+        # Build the entry under a temporary name so an interrupted run never leaves half an entry
+        building = entry + '.%d' % os.getpid()
+        os.makedirs(building, exist_ok=True)
+        try:
+            height, width = images.shape[1:3]
+            out = np.lib.format.open_memmap(os.path.join(building, 'images.npy'), mode='w+', dtype=np.uint8,
+                                            shape=(len(images), int(width * scale), int(height * scale)))
+            preprocess_batch(images, scale, out=out)
+            out.flush()
+            del out
+            if points is not None:
+                np.save(os.path.join(building, 'points.npy'), resize_points(points, scale))
+            with open(os.path.join(building, 'source.json'), 'w') as f:
+                json.dump({'path': os.path.abspath(path), 'scale': scale, 'version': preprocess_version}, f)
+            try:
+                os.rename(building, entry)
+            except OSError:
+                # Another run finished the same entry first, so this copy isn't needed
+                shutil.rmtree(building, ignore_errors=True)
+        finally:
+            # Never leave half an entry behind when preprocessing or saving fails
+            if os.path.exists(building):
+                shutil.rmtree(building, ignore_errors=True)
+
+    images = np.load(os.path.join(entry, 'images.npy'), mmap_mode='r')
+    points_path = os.path.join(entry, 'points.npy')
+    points = np.load(points_path, mmap_mode='r') if os.path.exists(points_path) else None
+    return images, points
+
+def load_preprocessed(path, cache_dir=cache_dir):
+    """
+    Preprocessed images and resized points of a dataset, through the cache unless cache_dir is empty
+    """
+    if cache_dir:
+        return cached_preprocess(path, resize_scale, cache_dir)
+    images, points = load_data(path)
+    return preprocess_batch(images, resize_scale), None if points is None else resize_points(points, resize_scale)
+
+def default_damping(num_regressors):
+    return np.linspace(1.0, 0.1, num_regressors).tolist()
+
+def split_indices(num_images, test_size=test_size, random_state=split_seed):
+    """
+    Index arrays of a train/test split, the same split train_test_split makes of the arrays themselves
+    :return: The train indices and the test indices
+    """
+    from sklearn.model_selection import train_test_split
+    return train_test_split(np.arange(num_images), test_size=test_size, random_state=random_state)
+
+def kfold_indices(num_images, num_folds=5, random_state=split_seed):
+    """
+    Index arrays of shuffled K-fold cross-validation
+    :return: A generator of (train indices, test indices) for each fold
+    """
+    from sklearn.model_selection import KFold
+    return KFold(num_folds, shuffle=True, random_state=random_state).split(np.arange(num_images))
+
+class StackSubset:
+    """
+    The rows of a stack picked out by an index array, without copying them. Rows are only gathered
+    when they are used, one image or one slice at a time, so a split of a preprocessed (or
+    memory-mapped) stack can be handed to cascaded_regression and regression_predict directly
+    """
+    def __init__(self, stack, indices):
+        self.stack = stack
+        self.indices = np.asarray(indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    @property
+    def shape(self):
+        return (len(self.indices),) + self.stack.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.stack.dtype
+
+    @property
+    def nbytes(self):
+        return len(self.indices) * self.stack[:1].nbytes
+
+    def __getitem__(self, key):
+        if np.isscalar(key):
+            return self.stack[self.indices[key]]
+        return subset(self.stack, self.indices[key], gather=True)
+
+    def __iter__(self):
+        for index in self.indices:
+            yield self.stack[index]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(subset(self.stack, self.indices, gather=True), dtype=dtype)
+
+def subset(stack, indices, gather=False):
+    """
+    Select rows of a stack by index, as a view when the indices are a contiguous ascending range
+    :param gather: Gather any other selection into a new array instead of returning a StackSubset
+    """
+    indices = np.asarray(indices)
+    if isinstance(stack, StackSubset) and not gather:
+        # Stay a subset of the underlying stack rather than gathering a contiguous run of rows
+        return StackSubset(stack.stack, stack.indices[indices])
+    if len(indices) and np.array_equal(indices, np.arange(indices[0], indices[0] + len(indices))):
+        return stack[indices[0]:indices[0] + len(indices)]
+    return stack[indices] if gather else StackSubset(stack, indices)
+
+# Mirroring a face swaps the left and right eyes and mouth corners
+flip_permutation = [1, 0, 2, 4, 3]
+
+class AugmentedStack:
+    """
+    Training images repeated and optionally mirrored by index, like StackSubset the rows are only
+    gathered (and flipped) when they are used, so augmenting doesn't copy the images
+    """
+    def __init__(self, images, indices, flipped):
+        self.images = images
+        self.indices = np.asarray(indices)
+        self.flipped = np.asarray(flipped, dtype=bool)
+
+    def __len__(self):
+        return len(self.indices)
+
+    @property
+    def shape(self):
+        return (len(self.indices),) + self.images.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.images.dtype
+
+    def __getitem__(self, key):
+        if np.isscalar(key):
+            image = self.images[self.indices[key]]
+            return image[:, ::-1] if self.flipped[key] else image
+        images = np.asarray(subset(self.images, self.indices[key], gather=True))
+        return np.where(self.flipped[key][:, np.newaxis, np.newaxis], images[:, :, ::-1], images)
+
+    def __iter__(self):
+        for key in range(len(self)):
+            yield self[key]
+
+def augmented_training_set(images, points, num_inits=4, flip=False, init_points=None, translation=2.0, scale=0.1,
+                           rotation=np.radians(10), random_state=0):
+    """
+    Augment a training set with several perturbed initial shapes per image, and optionally mirrored
+    copies of the images with their points flipped and swapped by flip_permutation. Only indices and
+    points are made here, the images are gathered a chunk at a time by cascaded_regression
+    :param images: The preprocessed training images
+    :param points: Their points
+    :param num_inits: Number of initial shapes per image (and per mirrored image), the first is init_points itself
+    :param init_points: The shape the initial shapes are perturbed from, defaults to the average points
+    :param translation, scale, rotation: How far the initial shapes are perturbed, see perturb_shapes
+    :return: (AugmentedStack of the samples, their target points, their initial points)
+    """
+    num_images = len(images)
+    if init_points is None:
+        init_points = np.mean(points, axis=0)
+    indices = np.tile(np.repeat(np.arange(num_images), num_inits), 2 if flip else 1)
+    flipped = np.repeat([False, True] if flip else [False], num_images * num_inits)
+
+    sample_points = np.asarray(points)[indices]
+    mirrored = sample_points[flipped][:, flip_permutation]
+    mirrored[..., 0] = images.shape[2] - 1 - mirrored[..., 0]
+    sample_points[flipped] = mirrored
+
+    inits = perturb_shapes(init_points, len(indices), translation, scale, rotation, random_state)
+    inits[::num_inits] = init_points
+    return AugmentedStack(images, indices, flipped), sample_points, inits
+
+def train_augmented(num_regressors, damping_factors, images, points, init_points, num_inits=4, flip=False,
+                    chunk_size=256, ridge='auto', num_workers=None, dtype=compute_dtype, checkpoint_dir=None):
+    """
+    cascaded_regression on an augmented_training_set. Each stage is solved from chunks of samples with
+    NormalEquations, so memory doesn't grow with the number of initial shapes, and the descriptors of
+    every chunk are computed over a thread pool
+    :param ridge: Regularisation strength of each stage. The repeated images make an unregularised fit
+        overfit badly, so it's picked per stage by default, see NormalEquations.solve
+    :param num_workers: Number of threads describing each chunk, defaults to the number of cores
+    :param checkpoint_dir: Save and resume the stages here, see cascaded_regression
+    :return: The list of fitted regressors, one per stage
+    """
+    samples, sample_points, inits = augmented_training_set(images, points, num_inits, flip, init_points)
+    return cascaded_regression(num_regressors, damping_factors, samples, sample_points,
+                               partial(threaded_features, num_workers=num_workers), inits, chunk_size, ridge, dtype,
+                               checkpoint_dir)
+
+def benchmark_augmentation(train_images, train_points, test_images, test_points, init_points,
+                           settings=((1, False), (4, False), (4, True)), ridge='auto', num_workers=None):
+    """
+    Compare training with different augmentations, by training time and the test error starting from
+    the average points and from perturbed initial shapes fused by multi_init_predict
+    :param settings: The (initial shapes per image, mirrored) pairs to try
+    :param ridge: Regularisation strength of each stage, used for every setting so they compare fairly
+    :return: A list of (initial shapes, mirrored, training seconds, mean squared error, multi init mean squared error)
+    """
+    damping_factors = default_damping(num_regressors)
+    results = []
+    for num_inits, flip in settings:
+        start_time = time.perf_counter()
+        regressors = train_augmented(num_regressors, damping_factors, train_images, train_points, init_points,
+                                     num_inits, flip, ridge=ridge, num_workers=num_workers)
+        train_time = time.perf_counter() - start_time
+        predictions = regression_predict(test_images, regressors, damping_factors, init_points)
+        fused = multi_init_predict(test_images, regressors, damping_factors, init_points)
+        results.append((num_inits, flip, train_time, np.mean(np.square(test_points - predictions)),
+                        np.mean(np.square(test_points - fused))))
+        print("%d initial shapes, mirrored %s: trained in %.2fs, MSE %f, multi init MSE %f" % results[-1])
+    return results
+
+def evaluate_split(images, points, damping_factors, init_points, train_indices, test_indices, dtype=compute_dtype,
+                   ridge=0.0):
+    """
+    Train on some of a preprocessed labelled set and predict the rest
+    :param images: The preprocessed images
+    :param points: The resized points of the images
+    :param init_points: The initial prediction
+    :param train_indices: Indices of the images to train on
+    :param test_indices: Indices of the images to predict
+    :param dtype: Floating point type used for training and prediction
+    :param ridge: Regularisation strength of each stage, see cascaded_regression
+    :return: The predictions and the ground truth points of the test images
+    """
+    # Select the split from the already preprocessed images, without copying them
+    train_imgs_split, train_pts_split = subset(images, train_indices), points[train_indices]
+    test_imgs_split, test_pts_split = subset(images, test_indices), points[test_indices]
+
+    # run cascaded regression with the train/test split
+    start_time = time.perf_counter()
+    regressors = cascaded_regression(len(damping_factors), damping_factors, train_imgs_split, train_pts_split,
+                                     init_points=init_points, ridge=ridge, dtype=dtype)
+    print("training time: %.2fs" % (time.perf_counter() - start_time))
+    predictions = regression_predict(test_imgs_split, regressors, damping_factors, init_points, dtype=dtype)
+    return predictions, test_pts_split
+
+def compare_dtypes(images, points, damping_factors, init_points, train_indices, test_indices):
+    """
+    Check that training and predicting in float32 loses nothing noticeable against float64
+    :return: A dict mapping each dtype name to the mean squared error on the split
+    """
+    errors, predictions = {}, {}
+    for dtype in (np.float64, np.float32):
+        name = np.dtype(dtype).name
+        predictions[name], test_points = evaluate_split(images, points, damping_factors, init_points,
+                                                        train_indices, test_indices, dtype)
+        errors[name] = np.mean(np.square(test_points - predictions[name]))
+        print("%s Mean Squared Error: %f" % (name, errors[name]))
+    print("MSE difference: %g, largest point difference: %g" % (
+        errors['float32'] - errors['float64'], np.max(np.abs(predictions['float32'] - predictions['float64']))))
+    return errors
+
+def sweep_group(path, scale, keypoint_size, damping_schedules, test_size=test_size, random_state=split_seed,
+                cache_dir=cache_dir):
+    """
+    Train and test every damping schedule of a sweep that shares a resize scale and keypoint size, on a
+    split of the dataset preprocessed once. The stages are shared between schedules: the points after
+    each prefix of damping factors are kept, and since a stage's target and update are both scaled by
+    its damping factor, one unit damping fit of the next stage serves every damping factor after that prefix
+    :param path: A .npz file or a directory made by convert_dataset
+    :param damping_schedules: One sequence of damping factors per config, its length is the number of stages
+    :return: A list of (resize scale, keypoint size, damping factors, mean squared error, seconds) per schedule,
+        with the error in pixels at the default resize_scale. The seconds only count the work the schedule didn't share with the ones before it
+    """
+    from sklearn import linear_model
+
+    if cache_dir:
+        images, points = cached_preprocess(path, scale, cache_dir)
+    else:
+        images, points = load_data(path)
+        images, points = preprocess_batch(images, scale), resize_points(points, scale)
+    train_indices, test_indices = split_indices(len(images), test_size, random_state)
+    train_images, test_images = subset(images, train_indices), subset(images, test_indices)
+    train_points = np.asarray(points[train_indices], dtype=compute_dtype)
+    test_points = np.asarray(points[test_indices], dtype=compute_dtype)
+    init_points = np.mean(train_points, axis=0)
+    extract = partial(compute_stage_features, keypoint_size=keypoint_size)
+
+    # The train and test points after each prefix of damping factors, and the unit damping
+    # update of the stage after each prefix
+    shapes = {(): (np.tile(init_points, (len(train_indices), 1, 1)), np.tile(init_points, (len(test_indices), 1, 1)))}
+    unit_updates = {}
+    results = []
+    for damping_factors in damping_schedules:
+        damping_factors = tuple(float(damping) for damping in damping_factors)
+        start_time = time.perf_counter()
+        for i, damping in enumerate(damping_factors):
+            prefix = damping_factors[:i]
+            if prefix + (damping,) in shapes:
+                continue
+            train_shapes, test_shapes = shapes[prefix]
+            if prefix not in unit_updates:
+                x_train = extract(train_images, train_shapes)
+                model = linear_model.LinearRegression()
+                model.fit(x_train, (train_points - train_shapes).reshape(len(x_train), -1))
+                unit_updates[prefix] = (stage_predict(model, x_train).reshape(train_shapes.shape),
+                                        stage_predict(model, extract(test_images, test_shapes)).reshape(test_shapes.shape))
+            train_update, test_update = unit_updates[prefix]
+            shapes[prefix + (damping,)] = (train_shapes + damping ** 2 * train_update,
+                                           test_shapes + damping ** 2 * test_update)
+
+        # Measure the error in pixels at the default scale, like eval, so different scales compare
+        error = np.mean(np.square((test_points - shapes[damping_factors][1]) * resize_scale / scale))
+        results.append((scale, keypoint_size, damping_factors, error, time.perf_counter() - start_time))
+    return results
+
+def sweep(path, scales=(resize_scale,), keypoint_factors=(10,), stage_counts=(num_regressors,), final_dampings=(0.1,),
+          num_workers=None, cache_dir=cache_dir):
+    """
+    Evaluate every combination of settings on a train/test split. Configs with the same scale and
+    keypoint size run together in one sweep_group, sharing the preprocessed images and the stages
+    their damping schedules have in common, and the groups are spread over a process pool
+    :param path: A .npz file or a directory made by convert_dataset
+    :param scales: Resize scales to try
+    :param keypoint_factors: Keypoint sizes to try, as multiples of the resize scale
+    :param stage_counts: Numbers of regressors to try
+    :param final_dampings: Damping factors of the last stage to try, the schedule falls linearly from 1
+    :param num_workers: Number of processes, defaults to the number of cores
+    :return: A list of (resize scale, keypoint size, damping factors, mean squared error, seconds)
+    """
+    schedules = [tuple(np.linspace(1.0, final, count)) for count in stage_counts for final in final_dampings]
+    # Sorting puts schedules sharing a prefix next to each other
+    groups = [(path, scale, factor * scale, sorted(schedules), test_size, split_seed, cache_dir)
+              for scale in scales for factor in keypoint_factors]
+    if cache_dir:
+        # Preprocess each scale once up front rather than in every group that needs it
+        for scale in scales:
+            cached_preprocess(path, scale, cache_dir)
+
+    with multiprocessing.Pool(min(num_workers or os.cpu_count(), len(groups))) as pool:
+        results = [row for rows in pool.starmap(sweep_group, groups) for row in rows]
+
+    print("%8s %8s %6s %8s %10s %8s" % ('scale', 'keypoint', 'stages', 'damping', 'MSE', 'seconds'))
+    for scale, size, damping_factors, error, seconds in results:
+        print("%8g %8g %6d %8g %10f %8.2f" % (scale, size, len(damping_factors), damping_factors[-1], error, seconds))
+    return results
+
+def run_script(cache_dir=cache_dir):
+    """
+    The full coursework run: evaluate on a train/test split, train on every training image,
+    save the test predictions to results_task2.csv and show some of them
+    """
+    # Load the test data, the original images are shown at the end
+    test_images, _ = load_data(test_file)
+
+    # Preprocess the images and resize the train points to match the new image size
+    train_images_preprocessed, train_points_resized = load_preprocessed(train_file, cache_dir)
+    test_images_preprocessed, _ = load_preprocessed(test_file, cache_dir)
+
+    # Find the average of all the training points for initial SIFT descriptor keypoints
+    average_points = np.mean(train_points_resized, axis=0)
+    print("average points:\n", average_points)
+
+    damping_factors = default_damping(num_regressors)
+    print("damping factors:", damping_factors)
+
+    # Get a train/test split
+    train_indices, test_indices = split_indices(len(train_images_preprocessed))
+    predictions, test_pts_split_resized = evaluate_split(train_images_preprocessed, train_points_resized, damping_factors,
+                                                         average_points, train_indices, test_indices)
+    print("predictions shape:", predictions.shape)
+
+    # Calculate distance between the predictions and the ground truth points on the test split
+    distances = euclid_dist(predictions, test_pts_split_resized)
+    print("Distances:", distances)
+
+    # Calculate the mean squared error
+    mse = np.mean(np.square(test_pts_split_resized - predictions))
+    print("Mean Squared Error:", mse)
+
+    # Final predictions
+    # run cascaded regression with the full train images and train points
+    regressors = cascaded_regression(num_regressors, damping_factors, train_images_preprocessed, train_points_resized,
+                                     init_points=average_points)
+    # Save the cascade so predictions can be made later without retraining
+    save_cascade('cascade', regressors, damping_factors, average_points)
+    # then get predictions on all test images
+    test_predictions = regression_predict(test_images_preprocessed, regressors, damping_factors, average_points)
+    print("final predictions shape:", test_predictions.shape)
+
+    # Resize the final prediction points back to the original size and save to csv
+    test_predictions_resized = resize_points(test_predictions, 1 / resize_scale)
+    save_as_csv(test_predictions_resized)
+
+    # finally I can visualise the original size predictions with the original test images
+    for i in range(10):
+        idx = np.random.randint(0, test_images.shape[0])
+        visualise_pts(test_images[idx], test_predictions_resized[idx])
+
+def train_command(args):
+    images_preprocessed, points_resized = load_preprocessed(args.data, args.cache_dir)
+    average_points = np.mean(points_resized, axis=0)
+    damping_factors = np.array(args.damping) if args.damping else default_damping(args.num_regressors)
+
+    start_time = time.perf_counter()
+    if args.augment or args.flip:
+        regressors = train_augmented(len(damping_factors), damping_factors, images_preprocessed, points_resized,
+                                     average_points, args.augment or 1, args.flip, args.chunk_size or 256,
+                                     'auto' if args.ridge is None else args.ridge,
+                                     args.workers, args.dtype, args.checkpoint_dir)
+    else:
+        regressors = cascaded_regression(len(damping_factors), damping_factors, images_preprocessed, points_resized,
+                                         init_points=average_points, chunk_size=args.chunk_size, ridge=args.ridge or 0.0,
+                                         dtype=args.dtype, checkpoint_dir=args.checkpoint_dir)
+    print("training time: %.2fs" % (time.perf_counter() - start_time))
+    save_cascade(args.model, regressors, damping_factors, average_points, dtype=args.dtype)
+    print("saved cascade to", args.model)
+
+def predict_command(args):
+    cascade = load_cascade(args.model)
+    try:
+        check_cascade(cascade)
+    except ValueError as error:
+        sys.exit("%s: %s" % (args.model, error))
+
+    start_time = time.perf_counter()
+    if args.chunk_size:
+        # Stream the raw images through the cascade and write the points as they come
+        if not os.path.isdir(args.data):
+            # Only a converted directory is memory-mapped, a .npz is read into memory whole
+            print("note: %s is loaded into memory whole, convert it to a directory to stream it with constant memory"
+                  % args.data)
+        images, _ = load_data(args.data)
+        with open(args.out, 'w') as f:
+            for index, points in predict_stream(images, cascade, args.chunk_size, dtype=args.dtype):
+                f.write(','.join('%.18e' % value for value in points.ravel()) + '\n')
+        print("prediction time: %.2fs" % (time.perf_counter() - start_time))
+        print("saved predictions to", args.out)
+        return
+
+    images_preprocessed, _ = load_preprocessed(args.data, args.cache_dir)
+    predictions = regression_predict(images_preprocessed, cascade.regressors, cascade.damping_factors,
+                                     cascade.average_points, dtype=args.dtype)
+    print("prediction time: %.2fs" % (time.perf_counter() - start_time))
+
+    # Save the points at the original image size, one row of x,y pairs per image
+    predictions = resize_points(predictions, 1 / resize_scale)
+    np.savetxt(args.out, np.reshape(predictions, (len(predictions), -1)), delimiter=',')
+    print("saved predictions to", args.out)
+
+def eval_command(args):
+    images, points = load_preprocessed(args.data, args.cache_dir)
+    average_points = np.mean(points, axis=0)
+    damping_factors = default_damping(args.num_regressors)
+    if args.folds:
+        splits = kfold_indices(len(images), args.folds, args.seed)
+    else:
+        splits = [split_indices(len(images), args.test_size, args.seed)]
+
+    errors = []
+    for train_indices, test_indices in splits:
+        predictions, test_points = evaluate_split(images, points, damping_factors, average_points, train_indices,
+                                                  test_indices, args.dtype, args.ridge)
+        errors.append(np.mean(np.square(test_points - predictions)))
+        print("Mean Squared Error:", errors[-1])
+    if len(errors) > 1:
+        print("Mean over %d folds: %f (std %f)" % (len(errors), np.mean(errors), np.std(errors)))
+
+def bench_command(args):
+    images, points = load_data(args.data)
+    if args.limit:
+        images, points = images[:args.limit], points[:args.limit]
+    images_preprocessed = preprocess_batch(images, resize_scale)
+    points_resized = resize_points(points, resize_scale)
+    average_points = np.mean(points_resized, axis=0)
+    # Describe the points every image starts the cascade from
+    shapes = np.tile(average_points, (len(images), 1, 1))
+
+    if args.name == 'predict':
+        damping_factors = default_damping(num_regressors)
+        regressors = cascaded_regression(num_regressors, damping_factors, images_preprocessed, points_resized,
+                                         init_points=average_points)
+        benchmark_predict(images_preprocessed, regressors, damping_factors, average_points)
+    elif args.name == 'early-exit':
+        train_indices, test_indices = split_indices(len(images))
+        damping_factors = default_damping(num_regressors)
+        regressors = cascaded_regression(num_regressors, damping_factors, subset(images_preprocessed, train_indices),
+                                         points_resized[train_indices], init_points=average_points)
+        benchmark_early_exit(subset(images_preprocessed, test_indices), points_resized[test_indices], regressors,
+                             damping_factors, average_points)
+    elif args.name == 'tracking':
+        damping_factors = default_damping(num_regressors)
+        regressors = cascaded_regression(num_regressors, damping_factors, images_preprocessed[1:], points_resized[1:],
+                                         init_points=average_points)
+        cascade = Cascade(regressors, damping_factors, average_points, resize_scale, keypoint_size)
+        # Pan the first image, which the cascade wasn't trained on
+        benchmark_tracking(images[0], points[0], cascade)
+        benchmark_tracking(images[0], points[0], cascade, reinit_every=10)
+    elif args.name == 'multi-init':
+        train_indices, test_indices = split_indices(len(images))
+        damping_factors = default_damping(num_regressors)
+        regressors = cascaded_regression(num_regressors, damping_factors, subset(images_preprocessed, train_indices),
+                                         points_resized[train_indices], init_points=average_points)
+        benchmark_multi_init(subset(images_preprocessed, test_indices), points_resized[test_indices], regressors,
+                             damping_factors, average_points)
+    elif args.name == 'augment':
+        train_indices, test_indices = split_indices(len(images))
+        benchmark_augmentation(subset(images_preprocessed, train_indices), points_resized[train_indices],
+                               subset(images_preprocessed, test_indices), points_resized[test_indices], average_points,
+                               num_workers=args.workers)
+    elif args.name == 'dtype':
+        train_indices, test_indices = split_indices(len(images))
+        compare_dtypes(images_preprocessed, points_resized, default_damping(num_regressors), average_points,
+                       train_indices, test_indices)
+    elif args.name == 'preprocess':
+        benchmark_preprocess(images)
+    elif args.name == 'descriptors':
+        benchmark_descriptors(images_preprocessed, shapes)
+    elif args.name == 'atlas':
+        benchmark_atlas(images_preprocessed, shapes)
+    elif args.name == 'threads':
+        benchmark_threads(images_preprocessed, shapes, args.workers)
+    elif args.name == 'processes':
+        benchmark_processes(images_preprocessed, shapes, args.workers)
+
+def sweep_command(args):
+    start_time = time.perf_counter()
+    sweep(args.data, args.scales, args.keypoint_factors, args.stages, args.final_dampings, args.workers, args.cache_dir)
+    print("sweep time: %.2fs" % (time.perf_counter() - start_time))
+
+def convert_command(args):
+    start_time = time.perf_counter()
+    convert_dataset(args.data, args.out)
+    print("converted %s to %s in %.2fs" % (args.data, args.out, time.perf_counter() - start_time))
+
+def ridge_argument(value):
+    return value if value == 'auto' else float(value)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Face alignment with cascaded regression. '
+                                                 'Without a command the full coursework script is run.')
+    parser.add_argument('--cache-dir', default=cache_dir, help="where preprocessed datasets are cached, '' to disable")
+    parser.add_argument('--dtype', default=np.dtype(compute_dtype).name, choices=['float32', 'float64'],
+                        help='floating point type of the features, coefficients and points')
+    commands = parser.add_subparsers(dest='command')
+
+    train = commands.add_parser('train', help='train a cascade and save it')
+    train.add_argument('--data', default=train_file, help='training images and points, a .npz file or converted directory')
+    train.add_argument('--model', default='cascade', help='directory to save the cascade in')
+    train.add_argument('--num-regressors', type=int, default=num_regressors)
+    train.add_argument('--chunk-size', type=int, help='solve each stage from features streamed in chunks of this many images')
+    train.add_argument('--ridge', type=ridge_argument,
+                       help="ridge regularisation of each stage, or 'auto'. Defaults to 0, or 'auto' with --augment or --flip")
+    train.add_argument('--damping', type=float, nargs='+', help='damping factor of each stage, overrides --num-regressors')
+    train.add_argument('--checkpoint-dir', help='save each stage here and resume after the stages already saved')
+    train.add_argument('--augment', type=int, help='train from this many perturbed initial shapes per image')
+    train.add_argument('--flip', action='store_true', help='also train on mirrored images')
+    train.add_argument('--workers', type=int, help='number of threads describing augmented training chunks')
+    train.set_defaults(func=train_command)
+
+    predict = commands.add_parser('predict', help='predict points with a saved cascade')
+    predict.add_argument('--data', default=test_file, help='images to predict points for, a .npz file or converted directory')
+    predict.add_argument('--model', default='cascade', help='directory the cascade was saved in')
+    predict.add_argument('--out', default='predictions.csv', help='csv file to save the points in')
+    predict.add_argument('--chunk-size', type=int, help='stream the images through in chunks of this size, with constant memory for a converted directory')
+    predict.set_defaults(func=predict_command)
+
+    evaluate = commands.add_parser('eval', help='train and test on a split of a labelled set')
+    evaluate.add_argument('--data', default=train_file, help='training images and points, a .npz file or converted directory')
+    evaluate.add_argument('--num-regressors', type=int, default=num_regressors)
+    evaluate.add_argument('--test-size', type=float, default=test_size)
+    evaluate.add_argument('--seed', type=int, default=split_seed)
+    evaluate.add_argument('--folds', type=int, help='run K-fold cross-validation instead of a single split')
+    evaluate.add_argument('--ridge', type=ridge_argument, default=0.0, help="ridge regularisation of each stage, or 'auto'")
+    evaluate.set_defaults(func=eval_command)
+
+    bench = commands.add_parser('bench', help='run one of the benchmarks')
+    bench.add_argument('name', choices=['predict', 'early-exit', 'tracking', 'multi-init', 'augment', 'dtype', 'preprocess', 'descriptors', 'atlas', 'threads', 'processes'])
+    bench.add_argument('--data', default=train_file, help='training images and points, a .npz file or converted directory')
+    bench.add_argument('--limit', type=int, help='only use the first LIMIT images')
+    bench.add_argument('--workers', type=int, help='largest number of threads or processes to try')
+    bench.set_defaults(func=bench_command)
+
+    sweeper = commands.add_parser('sweep', help='evaluate combinations of settings on a train/test split')
+    sweeper.add_argument('--data', default=train_file, help='training images and points, a .npz file or converted directory')
+    sweeper.add_argument('--scales', type=float, nargs='+', default=[resize_scale])
+    sweeper.add_argument('--keypoint-factors', type=float, nargs='+', default=[10], help='keypoint sizes as multiples of the scale')
+    sweeper.add_argument('--stages', type=int, nargs='+', default=[num_regressors], help='numbers of regressors')
+    sweeper.add_argument('--final-dampings', type=float, nargs='+', default=[0.1], help='damping factors of the last stage')
+    sweeper.add_argument('--workers', type=int, help='number of processes')
+    sweeper.set_defaults(func=sweep_command)
+
+    convert = commands.add_parser('convert', help='convert a .npz dataset to memory-mappable .npy files')
+    convert.add_argument('data', help='.npz file to convert')
+    convert.add_argument('out', help='directory to write images.npy and points.npy to')
+    convert.set_defaults(func=convert_command)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        run_script(args.cache_dir)
+    else:
+        args.func(args)
+
+if __name__ == '__main__':
+    main()